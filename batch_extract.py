@@ -0,0 +1,44 @@
+"""
+Extract face features from a whole cohort of sessions on a process pool.
+
+Sessions are split into shards of `--shard-frames` frames; every worker process loads one detector and landmark
+model and seeks straight to the start of each shard it gets. Finished shards leave a `.done` checkpoint next to
+their feature file, so re-running the same command resumes where it stopped.
+
+    $ python batch_extract.py data/ --out features/ --workers 8
+"""
+from multiprocessing import freeze_support
+import argparse
+import os
+
+from utils.session import find_sessions
+from utils.face import DETECTORS
+from utils import batch, features
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sessions", nargs="+", help="session directories, archives, or folders containing them")
+    parser.add_argument("--out", default="features", help="output folder (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes (default: %(default)s)")
+    parser.add_argument("--shard-frames", type=int, default=9000,
+                        help="frames per shard, 5 minutes at 30 fps by default (default: %(default)s)")
+    parser.add_argument("--predictor", default=features.PREDICTOR_PATH)
+    parser.add_argument("--detector", default="hog", choices=list(DETECTORS))
+    parser.add_argument("--detect-width", type=int, default=features.DETECT_WIDTH,
+                        help="width the detector works on (default: %(default)s)")
+    parser.add_argument("--upsample", type=int, default=features.UPSAMPLE,
+                        help="upsampling steps of the hog and cnn detectors (default: %(default)s)")
+    parser.add_argument("--detect-every", type=int, default=1)
+    parser.add_argument("--format", default="parquet" if features.pa is not None else "features",
+                        choices=["parquet", "features"])
+    args = parser.parse_args()
+
+    shards = batch.plan_shards(find_sessions(args.sessions), args.out, args.shard_frames, args.format)
+    batch.run_batch(shards, args.workers, args.predictor, args.detector,
+                    features.detector_options(args.detector, args.upsample), args.detect_width, args.detect_every)
+
+
+if __name__ == '__main__':
+    freeze_support()
+    main()
@@ -0,0 +1,157 @@
+"""
+Compare the face detector backends of `utils.face` on a folder of recorded frames.
+
+For every backend, frames are resized to the preview width and run through a `FaceTracker` that detects on every
+frame, exactly as the camera setup screen does without tracking. Accuracy is measured against `--labels`
+(a CSV of `file,x,y,w,h` in original frame coordinates, with an empty box for frames without a face)
+or, without labels, against the reference backend at full preview resolution.
+
+    $ python benchmark_detectors.py frames/ --detectors hog haar dnn --dnn-model models/
+"""
+import argparse
+import glob
+import os
+import time
+
+import cv2
+
+from utils.face import FaceTracker, DETECTORS, make_detector, is_centered, min_detect_width
+
+
+EXTENSIONS = ("*.png", "*.jpg", "*.jpeg", "*.bmp")
+
+
+def load_frames(folder, width):
+    paths = sorted(p for ext in EXTENSIONS for p in glob.glob(os.path.join(folder, ext)))
+    frames = []
+    for path in paths:
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        scale = width / img.shape[1]
+        img = cv2.resize(img, (width, int(img.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+        frames.append((os.path.basename(path), img, scale))
+    return frames
+
+
+def load_labels(path):
+    labels = {}
+    with open(path, 'r', encoding='UTF-8') as f:
+        for line in f:
+            fields = line.strip().split(",")
+            if len(fields) == 0 or fields[0] == "" or fields[0] == "file":
+                continue
+            if len(fields) >= 5 and fields[1] != "":
+                labels[fields[0]] = tuple(float(v) for v in fields[1:5])
+            else:
+                labels[fields[0]] = None
+    return labels
+
+
+def iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0., min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0., min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    union = aw * ah + bw * bh - inter
+    return inter / union if union > 0 else 0.
+
+
+def run_detector(detector, frames, detect_width):
+    tracker = FaceTracker(detect_width=detect_width, detect_every=1, detector=detector)
+    boxes = []
+    start = time.perf_counter()
+    for name, img, scale in frames:
+        boxes.append(tracker.update(img))
+    elapsed = time.perf_counter() - start
+    return boxes, elapsed
+
+
+def score(boxes, truth, frames, min_iou):
+    """
+    :return: (detection accuracy, centering agreement)
+    """
+    hits = 0
+    centering = 0
+    for box, expected, (name, img, scale) in zip(boxes, truth, frames):
+        h, w = img.shape[:2]
+        if expected is None:
+            hits += box is None
+        elif box is not None:
+            hits += iou(box, expected) >= min_iou
+        centered = box is not None and is_centered(box, w, h)
+        expected_centered = expected is not None and is_centered(tuple(int(v) for v in expected), w, h)
+        centering += centered == expected_centered
+    n = max(1, len(frames))
+    return hits / n, centering / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("frames", help="folder of recorded frames")
+    parser.add_argument("--detectors", nargs="+", default=list(DETECTORS), choices=list(DETECTORS))
+    parser.add_argument("--labels", help="ground truth CSV (file,x,y,w,h)")
+    parser.add_argument("--reference", default="hog", choices=list(DETECTORS),
+                        help="backend used as ground truth without --labels (default: %(default)s)")
+    parser.add_argument("--width", type=int, default=500, help="preview width (default: %(default)s)")
+    parser.add_argument("--detect-width", type=int, default=min_detect_width(),
+                        help="width the detector works on; the default is the smallest at which HOG finds "
+                             "every face the alignment check accepts (default: %(default)s)")
+    parser.add_argument("--min-iou", type=float, default=0.5)
+    parser.add_argument("--min-centering", type=float, default=0.95,
+                        help="centering agreement required to recommend a backend (default: %(default)s)")
+    parser.add_argument("--cnn-model", default="mmod_human_face_detector.dat")
+    parser.add_argument("--dnn-model", default=".", help="folder with deploy.prototxt and the res10 caffemodel")
+    parser.add_argument("--haar-cascade", default=None)
+    args = parser.parse_args()
+
+    options = {
+        "hog": {},
+        "cnn": {"model": args.cnn_model},
+        "dnn": {"prototxt": os.path.join(args.dnn_model, "deploy.prototxt"),
+                "model": os.path.join(args.dnn_model, "res10_300x300_ssd_iter_140000.caffemodel")},
+        "haar": {"cascade": args.haar_cascade},
+    }
+
+    frames = load_frames(args.frames, args.width)
+    if len(frames) == 0:
+        parser.error("no frames found in %s" % args.frames)
+
+    if args.labels is not None:
+        labels = load_labels(args.labels)
+        truth = []
+        for name, img, scale in frames:
+            box = labels.get(name)
+            truth.append(None if box is None else tuple(v * scale for v in box))
+    else:
+        reference_options = dict(options[args.reference])
+        if args.reference == "hog":
+            reference_options["upsample"] = 1
+        reference = make_detector(args.reference, **reference_options)
+        truth, _ = run_detector(reference, frames, args.width)
+
+    print("%d frames, ground truth: %s" % (len(frames), args.labels or "%s at %dpx" % (args.reference, args.width)))
+    print("%-6s %10s %10s %10s %10s" % ("", "frames/s", "faces/s", "accuracy", "centering"))
+    results = []
+    for name in args.detectors:
+        try:
+            detector = make_detector(name, **options[name])
+        except RuntimeError as e:
+            print("%-6s skipped: %s" % (name, e))
+            continue
+        boxes, elapsed = run_detector(detector, frames, args.detect_width)
+        found = sum(box is not None for box in boxes)
+        accuracy, centering = score(boxes, truth, frames, args.min_iou)
+        results.append((name, len(frames) / elapsed, centering))
+        print("%-6s %10.1f %10.1f %10.3f %10.3f" % (name, len(frames) / elapsed, found / elapsed, accuracy, centering))
+
+    passing = [r for r in results if r[2] >= args.min_centering]
+    if len(passing) > 0:
+        print("fastest backend passing the centering check: %s" % max(passing, key=lambda r: r[1])[0])
+    else:
+        print("no backend reaches %.0f%% centering agreement" % (args.min_centering * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Extract the video before every probe of recorded sessions.
+
+The `sound` lines of every `probe_<name>.txt` are joined with their answers and mapped onto frame ranges through
+the video timeline; each window is then read by seeking straight to its first frame, several clips at a time.
+Clips are named `<session>_<log>_<NNN>_<answer>.<fmt>` and listed in `<out>/clips.csv`.
+
+    $ python extract_clips.py output_user_*.zip --seconds 10 --out clips/
+"""
+import argparse
+import os
+
+from utils.session import Session, find_sessions
+from utils import clips
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sessions", nargs="+", help="session directories, archives, or folders containing them")
+    parser.add_argument("--out", default="clips", help="output folder (default: %(default)s)")
+    parser.add_argument("--seconds", type=float, default=10., help="window before each probe (default: %(default)s)")
+    parser.add_argument("--format", default="mp4", choices=["mp4", "npz"],
+                        help="video clips or frame arrays (default: %(default)s)")
+    parser.add_argument("--width", type=int, default=None, help="downscale frames to this width")
+    parser.add_argument("--workers", type=int, default=4, help="clips extracted in parallel (default: %(default)s)")
+    parser.add_argument("--unanswered", action="store_true", help="also extract probes without an answer")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    index_path = os.path.join(args.out, "clips.csv")
+    new_index = not os.path.isfile(index_path)
+    with open(index_path, 'a', encoding='UTF-8') as index:
+        if new_index:
+            index.write("session,log,number,sound_t,response_t,answer,first_frame,last_frame,frames,file\n")
+        for path in find_sessions(args.sessions):
+            with Session(path) as session:
+                probes = clips.load_session_probes(session)
+                if not args.unanswered:
+                    probes = [p for p in probes if p.answer != ""]
+                selected = clips.index_clips(session.timeline(), probes, args.seconds)
+                results = clips.extract_clips(session, selected, args.out, args.format, args.width, args.workers)
+                for clip, clip_path, n in results:
+                    p = clip.probe
+                    index.write("%s,%s,%d,%f,%f,%s,%d,%d,%d,%s\n" % (
+                        session.name, p.log, p.number, p.sound_t, p.response_t, p.answer,
+                        clip.start, clip.stop - 1, n, os.path.basename(clip_path) if n > 0 else ""))
+                index.flush()
+                print("%s,%d probes,%d clips" % (session.name, len(probes), sum(n > 0 for _, _, n in results)),
+                      flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Extract per-frame face features from recorded sessions.
+
+Every session (a session directory or `output_user_<id>.zip`) is streamed frame by frame; the face box,
+68 landmarks, head pose and eye aspect ratios of each frame are written to `<out>/<session>.parquet`
+(or `<session>.features` without pyarrow), indexed by the frame index and video timeline timestamp.
+
+    $ python extract_features.py output_user_*.zip --out features/
+"""
+import argparse
+import time
+import os
+
+from utils.session import Session, find_sessions
+from utils.face import DETECTORS, make_detector
+from utils import features
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sessions", nargs="+", help="session directories, archives, or folders containing them")
+    parser.add_argument("--out", default="features", help="output folder (default: %(default)s)")
+    parser.add_argument("--predictor", default=features.PREDICTOR_PATH)
+    parser.add_argument("--detector", default="hog", choices=list(DETECTORS))
+    parser.add_argument("--detect-width", type=int, default=features.DETECT_WIDTH,
+                        help="width the detector works on (default: %(default)s)")
+    parser.add_argument("--upsample", type=int, default=features.UPSAMPLE,
+                        help="upsampling steps of the hog and cnn detectors (default: %(default)s)")
+    parser.add_argument("--detect-every", type=int, default=1,
+                        help="track the face between detections on every Nth frame (default: %(default)s)")
+    parser.add_argument("--format", default="parquet" if features.pa is not None else "features",
+                        choices=["parquet", "features"])
+    parser.add_argument("--chunk", type=int, default=1024, help="rows per chunk (default: %(default)s)")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    for path in find_sessions(args.sessions):
+        with Session(path) as session:
+            out_path = os.path.join(args.out, "%s.%s" % (session.name, args.format))
+            detector = make_detector(args.detector, **features.detector_options(args.detector, args.upsample))
+            extractor = features.LandmarkExtractor(args.predictor, detector, args.detect_width, args.detect_every)
+            writer = features.FeatureWriter(out_path, args.chunk)
+            start = time.perf_counter()
+            try:
+                n = features.extract_session(session, extractor, writer, progress=lambda n: print(
+                    "\r%s,%d,%.1f" % (session.name, n, n / (time.perf_counter() - start)), end="", flush=True))
+            finally:
+                writer.close()
+            elapsed = time.perf_counter() - start
+            print("\r%s,%d frames,%.1f frames/s,%s" % (session.name, n, n / max(elapsed, 1e-9), out_path), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,20 @@
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
-import dlib
 import cv2
 
-from multiprocessing import Event, freeze_support, SimpleQueue
-from imutils import face_utils
+from multiprocessing import Event, freeze_support
+from queue import SimpleQueue, Empty
 from threading import Thread
 from enum import Enum, auto
 import functools
 import traceback
-import imutils
-import shutil
 import signal
 import time
 import sys
 import os
 
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 from utils import *
 
@@ -36,53 +33,68 @@ class ProbeRunner(QThread):
         self.end_event = Event()
         self.queue = queue
         self.name = name
+        self.iterations = metrics.REGISTRY.counter("probe.%s.iterations" % name)
+        metrics.REGISTRY.gauge("probe.%s.queue_depth" % name, queue.qsize)
 
     def execute(self):
         self.event.set()
 
     def finish(self, timeout=None):
         self.event.clear()
-        self.end_event.wait(timeout=timeout)
+        self.queue.put(None)  # Wake up the scheduler
+        return self.end_event.wait(timeout=timeout)
 
     def run(self) -> None:
         self.event.wait()
 
+        period = 40  # s
+        min_interval = 20  # s
         max_response = 10  # s
 
         clock_before = 0
         idx_before = 0
 
-        output_str = ""
+        output = eventlog.ProbeLog(os.path.join(BASE_PATH, "probe_%s.txt" % self.name),
+                                   os.path.join(BASE_PATH, "probe_%s.bin" % self.name))
         last_probe = None
-        added = True
+        window_open = False
 
-        while True:
+        while self.event.is_set():
+            self.iterations.inc()
             clock_now = time.time()
 
             # Play ding sound
-            if (clock_now % 40) < 5. and (clock_now - clock_before) > 20.:
+            if (clock_now % period) < 5. and (clock_now - clock_before) > min_interval:
                 sound.play(get_resource("Ding-sound-effect.mp3"))
-                output_str += "%f,sound\n" % clock_now
+                output.sound(clock_now)
                 idx_before += 1
                 clock_before = clock_now
                 last_probe = None
-                added = False
+                window_open = True
 
             # Give 10 seconds padding for report
-            if (clock_now - clock_before) > 10:
-                while not self.queue.empty():
-                    e: Tuple[float, str] = self.queue.get()
-                    if 0. <= e[0] - clock_before < max_response:
-                        if last_probe is not None and last_probe[1] != e[1]:  # drop when user type different responses
-                            last_probe = None
-                        else:
-                            last_probe = e
-                if last_probe is not None and not added:
-                    output_str += "%f,%f,probe,%s\n" % (clock_before, last_probe[0], last_probe[1])
-                    added = True
-
-                    with open(os.path.join(BASE_PATH, "probe_%s.txt" % self.name), 'w', encoding='UTF-8') as f:
-                        f.write(output_str)
+            if window_open and (clock_now - clock_before) > max_response:
+                window_open = False
+                if last_probe is not None:
+                    output.probe(clock_before, last_probe[0], last_probe[1])
+
+            # Sleep until the next probe or the end of the response window, unless a response arrives
+            wake_at = clock_now - (clock_now % period) + period
+            if window_open:
+                wake_at = min(wake_at, clock_before + max_response + 0.001)
+            try:
+                e: Optional[Tuple[float, str]] = self.queue.get(timeout=max(0., wake_at - time.time()))
+            except Empty:
+                continue
+
+            if e is not None and 0. <= e[0] - clock_before < max_response:
+                if last_probe is not None and last_probe[1] != e[1]:  # drop when user type different responses
+                    last_probe = None
+                else:
+                    last_probe = e
+
+        output.close()
+        self.end_event.set()
 
 
 def proceedFunction(state_before, state_after):
@@ -152,91 +164,102 @@ class ExpApp(QMainWindow):
         ERROR = auto()
 
     _state = State.START
+    _closing = False
+
+    camera_aligned = pyqtSignal()
+    archive_progress = pyqtSignal(int, int)
 
     def signal_handler(self, sig, frame):
         if sig == signal.SIGINT:
             traceback.print_stack(frame)
         self.close()
 
-    def log(self, string: str):
-        print(string, flush=True)
-        self.output.write("%f,%s,%s\n" % (time.time(), self._state, string))
+    def log(self, event: str, *payload):
+        """
+        :param event: event name, or a whole `event,fields` line
+        :param payload: typed fields, formatted on the logger thread
+        """
+        self.logger.log(self._state, event, *payload)
 
     @pyqtSlot("QWidget*", "QWidget*")
     def onFocusChanged(self, old, now):
         if now is None:
-            self.log("focus,False")
+            self.log("focus", False)
         else:
-            self.log("focus,True")
+            self.log("focus", True)
 
     def closeEvent(self, event):
-        self.log("click,x")
+        self.log("click", "x")
         self.close()
 
     def close(self):
+        if self._closing:
+            return
+        self._closing = True
+
         try:
             self.media_player.stop()
         except Exception as e:
             self.log(str(e))
 
-        try:
-            self.probeRunner.finish(timeout=5.0)
-            #self.probeRunner.terminate()
-        except Exception as e:
-            self.log(str(e))
+        # Stop every recorder at once; shutdown never takes longer than the deadline
+        coordinator = ShutdownCoordinator(self.log)
+        if self.probeRunner is not None:
+            coordinator.add("probeRunner", finisher(self.probeRunner))
+        if self.videoRecorder is not None:
+            coordinator.add("videoRecorder", finisher(self.videoRecorder))
+        if self.activityRecorder is not None:
+            coordinator.add("activityRecorder", finisher(self.activityRecorder))
+        if self.capture is not None:
+            # The recorder unsubscribes before the device is released
+            coordinator.add("capture", lambda timeout: self.capture.stop(timeout=timeout), after=["videoRecorder"])
+        # Last snapshot once the recorders stopped
+        coordinator.add("metrics", finisher(self.metrics_reporter),
+                        after=["probeRunner", "videoRecorder", "activityRecorder", "capture"])
+        coordinator.run(timeout=10.0)
 
         try:
-            self.videoRecorder.finish(timeout=5.0)
-            self.activityRecorder.finish(timeout=5.0)
+            if self.archiver is None:
+                self.start_archive()
+            self.logger.sync()
+            # Pack the remaining files on the archiver thread and keep the finish screen responsive meanwhile
+            archiver = self.archiver
+            archiver.finish()
+            while archiver.is_alive():
+                qApp.processEvents()
+                archiver.join(timeout=0.05)
+            if archiver.error is not None:
+                raise archiver.error
+            self.log("archive", archiver.path, archiver.incremental, archiver.total, "%f" % archiver.elapsed)
         except Exception as e:
             self.log(str(e))
 
-        try:
-            self.probeRunner.finish(timeout=5.0)
-            #self.probeRunner.terminate()
-        except Exception as e:
-            self.log(str(e))
+        self.logger.close(timeout=1.0)
 
-        try:
-            self.videoRecorder.finish(timeout=10.0)
-            self.videoRecorder.join()
-            #self.videoRecorder.join(timeout=2.0)
-            #self.videoRecorder.terminate()
-        except Exception as e:
-            self.log(str(e))
+        # os.system("start https://forms.gle/1111")
+        # taskbar.unhide_taskbar()
+        sys.exit(0)
 
-        try:
-            self.activityRecorder.finish(timeout=3.0)
-            self.activityRecorder.join()
-            #self.activityRecorder.join(timeout=2.0)
-            #self.activityRecorder.terminate()
-        except Exception as e:
-            self.log(str(e))
+    def start_archive(self):
+        """
+        Open `output_user_<id>.zip`; finished files are appended during the session, the rest in `close`.
+        """
+        #output_name = os.path.join("../../../", "output_user_%s" % self.user_id.text())  # darwin
+        output_name = os.path.join("./", "output_user_%s" % self.user_id.text())
+        save_idx = 0
+        while os.path.isfile(output_name+".zip") or os.path.isfile(output_name+".zip.part"):
+            save_idx += 1
+            output_name = output_name.split("(")[0] + ("(%d)" % save_idx)
 
-        try:
-            if sys.platform == "darwin":
-                #output_name = os.path.join("../../../", "output_user_%s" % self.user_id.text())
-                output_name = os.path.join("./", "output_user_%s" % self.user_id.text())
-                save_idx = 0
-                while os.path.isfile(output_name+".zip"):
-                    save_idx += 1
-                    output_name = output_name.split("(")[0] + ("(%d)" % save_idx)
-                shutil.make_archive(output_name, 'zip', "./%s/"%BASE_PATH)
-            else:
-                output_name = os.path.join("./", "output_user_%s" % self.user_id.text())
-                save_idx = 0
-                while os.path.isfile(output_name+".zip"):
-                    save_idx += 1
-                    output_name = output_name.split("(")[0] + ("(%d)" % save_idx)
-                shutil.make_archive(output_name, 'zip', "./%s/"%BASE_PATH)
-        except Exception as e:
-            self.log(str(e))
+        self.archiver = SessionArchiver("./%s/" % BASE_PATH, output_name, progress=self.archive_progress.emit)
+        self.archiver.start()
 
-        self.output.close()
+    def archive_files(self, paths: List[str]):
+        if self.archiver is not None:
+            self.archiver.add(paths)
 
-        # os.system("start https://forms.gle/1111")
-        # taskbar.unhide_taskbar()
-        sys.exit(0)
+    def update_archive_progress(self, done: int, total: int):
+        self.finish_label.setText(self.finish_text + "Saving... %d%%" % (100 * done // max(total, 1)))
 
     def __init__(self, *args, **kwargs):
         QMainWindow.__init__(self, *args, **kwargs)
@@ -247,14 +270,32 @@ class ExpApp(QMainWindow):
         self._skip_camera = False
         self._skip_calib = False
 
+        # Main log: 'csv' (main_log.txt), 'jsonl' or 'binary'; mirror it to stdout.txt
+        self._log_format = "csv"
+        self._log_stdout = True
+
+        # Face detector of the camera setup screen: 'hog', 'cnn', 'dnn' or 'haar' (see `utils.face.DETECTORS`)
+        self._face_detector = "hog"
+
+        # Recording backend (see `utils.encoder.ENCODERS`); 'mjpg' passthrough needs its own device,
+        # so it is not available while the preview shares the camera
+        self._video_encoder = "mpeg"
+
         ########### MODIFY HERE! ######################################
         self.videos = []
         ###############################################################
 
         self.videoIndex = 0
 
-        self.output = open(os.path.join(BASE_PATH, "main_log.txt"), 'w', buffering=1, encoding='UTF-8')
-        self.camera = camera.select_camera(os.path.join(BASE_PATH, "test.png"))
+        log_name = {"csv": "main_log.txt", "jsonl": "main_log.jsonl", "binary": "main_log.bin"}[self._log_format]
+        self.logger = EventLogger(os.path.join(BASE_PATH, log_name), self._log_format,
+                                  mirror=sys.stdout if self._log_stdout else None)
+        self.logger.start()
+        # Snapshot the recorder metrics to metrics.jsonl every 5 s
+        self.metrics_reporter = metrics.MetricsReporter(os.path.join(BASE_PATH, "metrics.jsonl"))
+        self.metrics_reporter.start()
+        self.camera = camera.select_camera()
+        self.camera_mode: Optional[camera.CameraMode] = None
         if self.camera is None:
             self.log("cameraNotFound")
 
@@ -282,8 +323,12 @@ class ExpApp(QMainWindow):
             self.updater = None
 
             self.videoRecorder = None
+            self.archiver: Optional[SessionArchiver] = None
+            self.capture: Optional[CaptureService] = None
+            self.preview: Optional[Preview] = None
 
-            self.activityRecorder = ActivityRecorder(BASE_PATH, self.probeQueue, "Main")
+            self.activityRecorder = ActivityRecorder(BASE_PATH, self.probeQueue, "Main", move_window=0.008,
+                                                     log=self.log)
             self.activityRecorder.daemon = True
             self.activityRecorder.start()
             self.activityRecorder.execute()  # Start recording keyboard & mouse
@@ -406,7 +451,7 @@ class ExpApp(QMainWindow):
                 detail_text = QLabel(
                     'Now, you will proceed an loop of "Looking at a circle" -> "Clicking the circle".\n\n'
                     '- Please do not move your head during the step.\n\n'
-                    '- You may need to click multiples times.',
+                    '- Keep looking at the circle for a moment after clicking it.',
                     self
                 )
                 detail_text.setSizePolicy(QSizePolicy.Minimum, QSizePolicy.Minimum)
@@ -433,6 +478,12 @@ class ExpApp(QMainWindow):
                 self.ellipse_button.hide()
                 self.ellipse_button.clicked.connect(self.proceed)
 
+                # Polls the recorder while a calibration point is held, so the GUI thread never blocks on frames
+                self.calib_timer = QTimer(self)
+                self.calib_timer.setInterval(10)
+                self.calib_timer.timeout.connect(self.poll_calibration)
+                self.calib_deadline = 0.
+
                 calib_layout.addWidget(self.ellipse_button, alignment=Qt.AlignAbsolute)
                 self.calibration_widget.setLayout(calib_layout)
 
@@ -624,6 +675,7 @@ class ExpApp(QMainWindow):
                 finish_layout.addWidget(finish_button, alignment=Qt.AlignHCenter)
 
                 self.finish_widget.setLayout(finish_layout)
+                self.archive_progress.connect(self.update_archive_progress)
 
             # Maximize the screen
             self.showMaximized()
@@ -635,7 +687,6 @@ class ExpApp(QMainWindow):
             self.margin = 0
             self.calib_r = 50
             self.pos = 0
-            self.clicks = 0
             self.calib_started = False
             self.calib_position_center: List[Tuple[int, int]] = [(0, 0)]
 
@@ -698,6 +749,8 @@ class ExpApp(QMainWindow):
         self.log('inner_area,%d,%d' % (self.rect().width(), self.rect().height()))
         self.log('calibration_Radius,%d' % self.calib_r)
 
+        self.start_archive()
+
         # Resize frames
         self.camera_label.setFixedHeight(self.rect().height() - 200)
         self.video_frame.setFixedHeight(self.rect().height() - 30)
@@ -745,10 +798,7 @@ class ExpApp(QMainWindow):
         success = self.camera is not None
 
         if success:
-            if sys.platform=="darwin":
-                cap = cv2.VideoCapture(self.camera)
-            else:
-                cap = cv2.VideoCapture(self.camera, cv2.CAP_DSHOW)
+            cap = camera.open_camera(self.camera)
             cap.set(cv2.CAP_PROP_FPS, 30)
 
             if not cap.isOpened():
@@ -767,54 +817,82 @@ class ExpApp(QMainWindow):
                                       " - (Windows) No other app is using camera.")
             return
 
-        width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-        height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-        self.log("cameraCapture,%d,%d" % (int(width), int(height)))
-
-        def distance2(p1, p2):
-            return (p1[0]-p2[0])**2 + (p1[1]-p2[1])**2
+        # The device stays open for the whole session and is only ever read through this service;
+        # it is created here so the recorder never opens the device a second time, whatever the preview thread does
+        self.capture = CaptureService(cap, log=self.log)
 
         def frame_thread_run(success: Event):
-            detector = dlib.get_frontal_face_detector()
+            # Choose the cheapest capture mode that sustains 30 fps; the recorder reuses it
+            try:
+                self.camera_mode = camera.negotiate_mode(cap, target_fps=30)
+                self.log("cameraMode,%s" % self.camera_mode)
+            except Exception as e:
+                self.log("cameraMode,fail,%s" % e)
+
+            width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+            height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+            self.log("cameraCapture,%d,%d" % (int(width), int(height)))
+
+            # The preview only keeps the latest frame
+            latest = [None]
+            new_frame = Event()
+
+            def on_frame(frame, stamp):
+                latest[0] = frame
+                new_frame.set()
+
+            token = self.capture.subscribe(on_frame)
+            self.capture.start()
+
+            try:
+                detector = make_detector(self._face_detector)
+            except Exception as e:  # Missing model file or dlib build without the backend
+                self.log("faceDetector,fail,%s,%s" % (self._face_detector, e))
+                detector = make_detector("hog")
+            # Detect at the smallest width where HOG still finds every face `is_centered` accepts
+            tracker = FaceTracker(detect_width=min_detect_width(), detect_every=5, detector=detector)
+            detect_time = metrics.REGISTRY.histogram("preview.detect_ms")
             while not self.camera_running.is_set():
                 try:
-                    ret, img = cap.read()
-                    if ret:
-                        img = img.copy()
-                        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                        img = cv2.flip(img, 1)
-                        img = imutils.resize(img, width=500)
+                    ret = new_frame.wait(timeout=1.0)
+                    new_frame.clear()
+                    frame = latest[0]
+                    if ret and frame is not None:
+                        # Scale and mirror straight into a preview buffer; it stays BGR up to the QImage
+                        index, img = self.preview.render(frame)
 
                         # Detect face bounding box
-                        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                        rect = detector(gray, 1)
+                        start = time.perf_counter()
+                        face = tracker.update(img)
+                        detect_time.observe((time.perf_counter() - start) * 1000)
                         h, w, c = img.shape
                         t_size = w/5  # target size
-                        if len(rect) > 0:
-                            (x, y, x_d, y_d) = face_utils.rect_to_bb(rect[0])
-                            img = cv2.rectangle(img, (x, y), (x+x_d, y+y_d), (255, 0, 0), 2)
+                        if face is not None:
+                            (x, y, x_d, y_d) = face
+                            cv2.rectangle(img, (x, y), (x+x_d, y+y_d), (0, 0, 255), 2)
                             rect_center = (x+int(x_d/2), y+int(y_d/2))
-                            img = cv2.circle(img, rect_center, 1, (255, 0, 0), -1)
-                            if x_d >= t_size and distance2(rect_center, (int(w/2), int(h/2))) < t_size**2:
-                                self.camera_finish_button.setEnabled(True)
+                            cv2.circle(img, rect_center, 1, (0, 0, 255), -1)
+                            if is_centered(face, w, h) and not success.is_set():
                                 success.set()
+                                self.camera_aligned.emit()
 
                         # Draw target box
-                        img = cv2.rectangle(img, (int((w-t_size)/2), int((h-t_size)/2)),
-                                            (int((w+t_size)/2), int((h+t_size)/2)), (0, 0, 255), 2)
-                        img = cv2.circle(img, (int(w/2), int(h/2)), 1, (0, 0, 255), -1)
-                        img = imutils.resize(img, height=int(self.camera_label.height()))
+                        cv2.rectangle(img, (int((w-t_size)/2), int((h-t_size)/2)),
+                                      (int((w+t_size)/2), int((h+t_size)/2)), (255, 0, 0), 2)
+                        cv2.circle(img, (int(w/2), int(h/2)), 1, (255, 0, 0), -1)
 
-                        # Draw in PyQT
-                        h, w, c = img.shape
-                        image = QImage(img.data, w, h, w*c, QImage.Format_RGB888)
-                        pixmap = QPixmap.fromImage(image)
-                        self.camera_label.setPixmap(pixmap)
-                    else:
-                        break
+                        # Hand over to the GUI thread
+                        self.preview.publish(index)
                 except Exception as e:
                     self.log(str(e))
                     break
+            self.capture.unsubscribe(token)
+            self.log("faceDetection,%d,%d,%f,%f" % (tracker.frames, tracker.detections,
+                                                    tracker.mean_detect_time * 1000, tracker.mean_track_time * 1000))
+            self.log("preview,%d,%d" % (self.preview.rendered, self.preview.painted))
+
+        self.preview = Preview(self.camera_label)
+        self.camera_aligned.connect(lambda: self.camera_finish_button.setEnabled(True))
         success = Event()
         frame_thread = Thread(target=frame_thread_run, args=(success,))
         frame_thread.daemon = True
@@ -822,19 +900,23 @@ class ExpApp(QMainWindow):
 
         def camera_finished_wrapper():
             if success.is_set() or self._skip_camera:
-                self.camera_finished(frame_thread, cap)
+                self.camera_finished(frame_thread)
 
         self.camera_finish_button.clicked.connect(camera_finished_wrapper)
 
     @proceedFunction(State.SET_CAMERA, State.CALIB_INSTRUCTION)
-    def camera_finished(self, frame_thread, cap):
+    def camera_finished(self, frame_thread):
         self.camera_running.set()
 
         frame_thread.join()
-        cap.release()
-        # Start recording
-        self.videoRecorder = VideoRecorder(BASE_PATH, self.camera)
-        #self.videoRecorder.video_cap = cap
+        self.preview.stop()
+        if self.capture.ident is None:  # The preview thread failed before starting the capture
+            self.log("captureService,started late")
+            self.capture.start()
+        # Start recording from the already running capture
+        self.videoRecorder = VideoRecorder(BASE_PATH, self.camera, encoder=self._video_encoder,
+                                           segment_length=5 * 60, source=self.capture,
+                                           on_segment_closed=self.archive_files, log=self.log)
         self.videoRecorder.daemon = True
         self.videoRecorder.start()
         self.videoRecorder.execute()
@@ -865,6 +947,8 @@ class ExpApp(QMainWindow):
 
     @proceedFunction(State.CALIBRATION, None)  # Next: LECTURE_INSTRUCTION
     def calibrate(self):
+        if self.calib_timer.isActive():  # Still holding the current point
+            return
         self.log("calibrate,%d" % self.pos)
 
         if self._skip_calib:
@@ -872,14 +956,27 @@ class ExpApp(QMainWindow):
             self.ellipse_button.hide()
             self.end_calibrate()
             return
-        if self.clicks == 0:  # First click on the point
-            self.videoRecorder.setFrameCount()
-            self.clicks += 1
-        elif self.videoRecorder.getFrameCount() < 15:
-            self.clicks += 1
-        else:
-            self.clicks = 0
+        # Hold the point until 15 frames are captured while the user looks at it; see `poll_calibration`
+        self.ellipse_button.setEnabled(False)
+        self.videoRecorder.setFrameCount()
+        self.calib_deadline = time.monotonic() + 2.0
+        self.calib_timer.start()
+
+    def poll_calibration(self):
+        """
+        Timer callback on the GUI thread: move to the next point once 15 frames were captured, or retry the same point
+        after 2 seconds without them.
+        """
+        count = self.videoRecorder.getFrameCount()
+        if count >= 15:
             self.pos += 1
+        elif time.monotonic() < self.calib_deadline:
+            return
+        else:
+            self.log("calibrate,timeout,%d" % count)
+        self.calib_timer.stop()
+        self.ellipse_button.setEnabled(True)
+
         if self.pos >= len(self.calib_position_center):
             self.ellipse_button.hide()
             self.end_calibrate()
@@ -890,7 +987,9 @@ class ExpApp(QMainWindow):
 
     @proceedFunction(State.CALIBRATION, State.LECTURE_INSTRUCTION)
     def end_calibrate(self):
-        return
+        # Close the video segment of the setup and calibration phases so it is archived right away
+        if self.videoRecorder is not None:
+            self.videoRecorder.rotate_segment()
 
     @proceedFunction(State.LECTURE_INSTRUCTION, None)  # Next: DEMO_VIDEO
     def lecture_instruction(self):
@@ -904,8 +1003,10 @@ class ExpApp(QMainWindow):
 
         self.activityRecorder.finish(timeout=5.0)  # Stop recording keyboard & mouse
         self.activityRecorder.join()
+        self.archive_files(self.activityRecorder.files())
 
-        self.activityRecorder = ActivityRecorder(BASE_PATH, self.probeQueue, "waiting")
+        self.activityRecorder = ActivityRecorder(BASE_PATH, self.probeQueue, "waiting", move_window=0.008,
+                                                 log=self.log)
         self.activityRecorder.daemon = True
         self.activityRecorder.start()
         self.activityRecorder.execute()
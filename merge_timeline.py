@@ -0,0 +1,61 @@
+"""
+Merge every log of a recorded session into one time-ordered event stream.
+
+The main log (text, JSON lines or binary), the video timeline, the mouse, keyboard and probe logs are merged
+on the fly; every event carries the index of the last video frame captured before it and the experiment state
+at that time. The output format follows the extension: `.parquet`, `.npy` (NumPy structured array) or `.csv`.
+
+    $ python merge_timeline.py output_user_3.zip --out user_3_events.parquet --no-frames
+"""
+import argparse
+import os
+
+from utils.session import Session, find_sessions
+from utils import merge
+
+
+def write_csv(records, path):
+    n = 0
+    with open(path, 'w', encoding='UTF-8') as f:
+        f.write(",".join(merge.Record._fields) + "\n")
+        for record in records:
+            f.write("%f,%s,%s,\"%s\",%d,%d,%d,%d,%f,%d,%s\n" % (record[:3] + (record.value.replace('"', '""'),)
+                                                                 + record[4:]))
+            n += 1
+    return n
+
+
+WRITERS = {
+    ".parquet": merge.write_parquet,
+    ".npy": merge.write_npy,
+    ".csv": write_csv,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sessions", nargs="+", help="session directories, archives, or folders containing them")
+    parser.add_argument("--out", default=None,
+                        help="output file, or folder for several sessions (default: <session>_events.parquet/.npy)")
+    parser.add_argument("--format", default=".parquet" if merge.pa is not None else ".npy", choices=list(WRITERS),
+                        help="format when --out is a folder (default: %(default)s)")
+    parser.add_argument("--sources", nargs="+", default=None, help="only these sources, e.g. main mouse_Main")
+    parser.add_argument("--no-frames", action="store_true", help="leave out the per-frame video records")
+    args = parser.parse_args()
+
+    sessions = find_sessions(args.sessions)
+    for path in sessions:
+        with Session(path) as session:
+            if args.out is not None and os.path.splitext(args.out)[1] in WRITERS and len(sessions) == 1:
+                out_path = args.out
+            else:
+                out_dir = args.out if args.out is not None else "."
+                os.makedirs(out_dir, exist_ok=True)
+                out_path = os.path.join(out_dir, "%s_events%s" % (session.name, args.format))
+            records = merge.merge_session(session, args.sources, include_frames=not args.no_frames)
+            n = WRITERS[os.path.splitext(out_path)[1]](records, out_path)
+            print("%s,%d events,%s" % (session.name, n, out_path), flush=True)
+
+
+if __name__ == '__main__':
+    main()
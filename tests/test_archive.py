@@ -0,0 +1,75 @@
+"""
+Round trip of `utils.archive`: the precompressed members written through `zipfile` internals must read back
+byte for byte. Run on every Python version the app supports:
+
+    $ python -m unittest tests.test_archive
+"""
+from unittest import mock
+import unittest
+import tempfile
+import zipfile
+import shutil
+import os
+
+from utils import archive
+
+
+class ArchiveRoundTrip(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test_archive_")
+        self.base = os.path.join(self.tmp, "output")
+        os.makedirs(os.path.join(self.base, "segments"))
+        self.files = {
+            "main_log.txt": "".join("%f,State.MAIN_VIDEO,focus,True\n" % (i / 30) for i in range(20000)).encode(),
+            "mouse_log_Main.bin": bytes(range(256)) * 512,
+            "recording.mp4": os.urandom(300000),
+            "segments/recording_001.mjpeg": os.urandom(1000),
+            "empty.txt": b"",
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.base, name), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def check(self, path: str):
+        with zipfile.ZipFile(path) as z:
+            self.assertIsNone(z.testzip())
+            for name, data in self.files.items():
+                self.assertEqual(z.read(name), data, name)
+            self.assertEqual(set(z.namelist()), set(self.files) | {archive.MANIFEST})
+        self.assertEqual(archive.verify(path), [])
+
+    def run_archiver(self, add=()) -> archive.SessionArchiver:
+        archiver = archive.SessionArchiver(self.base, os.path.join(self.tmp, "session"), workers=2)
+        archiver.start()
+        archiver.add(os.path.join(self.base, name) for name in add)
+        archiver.finish()
+        archiver.join(timeout=30)
+        self.assertFalse(archiver.is_alive())
+        self.assertIsNone(archiver.error)
+        return archiver
+
+    def test_finish(self):
+        archiver = self.run_archiver()
+        self.check(archiver.path)
+        self.assertFalse(os.path.exists(archiver.path + ".part"))
+
+    def test_incremental(self):
+        archiver = self.run_archiver(add=["main_log.txt", "recording.mp4"])
+        self.assertEqual(archiver.incremental, 2)
+        self.check(archiver.path)
+
+    def test_public_api_fallback(self):
+        with mock.patch.object(archive, "can_write_deflated", return_value=False):
+            archiver = self.run_archiver(add=["main_log.txt"])
+        self.check(archiver.path)
+
+    def test_internals_available(self):
+        with zipfile.ZipFile(os.path.join(self.tmp, "probe.zip"), 'w') as z:
+            self.assertTrue(archive.can_write_deflated(z))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""
+`utils.shutdown.ShutdownCoordinator`: one global deadline, and stalls blamed on the component that stalled.
+
+    $ python -m unittest tests.test_shutdown
+"""
+from threading import Event
+import unittest
+import time
+
+from utils.shutdown import ShutdownCoordinator
+
+
+class ShutdownDeadline(unittest.TestCase):
+    def test_hanging_dependency(self):
+        lines = []
+        release = Event()
+        signalled = Event()
+
+        def hang(timeout):
+            release.wait(5.0)  # Ignores its timeout
+
+        coordinator = ShutdownCoordinator(lines.append)
+        coordinator.add("videoRecorder", hang)
+        coordinator.add("capture", lambda timeout: signalled.set(), after=["videoRecorder"])
+        coordinator.add("activityRecorder", lambda timeout: time.sleep(0.05))
+
+        start = time.monotonic()
+        results = {r.name: r for r in coordinator.run(timeout=0.3)}
+        self.assertLess(time.monotonic() - start, 1.0)
+
+        self.assertEqual(results["videoRecorder"].status, "timeout")
+        self.assertEqual(results["capture"].status, "blocked: videoRecorder")
+        self.assertEqual(results["activityRecorder"].status, "ok")
+        self.assertTrue(lines[-1].endswith("slowest,videoRecorder"), lines[-1])
+        # The blocked component is still told to stop once its dependency wait ends
+        self.assertTrue(signalled.wait(1.0))
+        release.set()
+
+    def test_slowest_excludes_dependency_wait(self):
+        lines = []
+        coordinator = ShutdownCoordinator(lines.append)
+        coordinator.add("videoRecorder", lambda timeout: time.sleep(0.2))
+        coordinator.add("metrics", lambda timeout: None, after=["videoRecorder"])
+        results = {r.name: r for r in coordinator.run(timeout=2.0)}
+
+        self.assertEqual(results["metrics"].status, "ok")
+        self.assertLess(results["metrics"].elapsed, 0.05)
+        self.assertGreaterEqual(results["metrics"].waited, 0.2)
+        self.assertTrue(lines[-1].endswith("slowest,videoRecorder"), lines[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
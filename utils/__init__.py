@@ -1,2 +1,8 @@
-from . import camera, sound, notification
+from . import camera, sound, notification, eventlog, metrics
 from .recorder import VideoRecorder, ActivityRecorder, get_resource
+from .capture import CaptureService
+from .face import FaceTracker, make_detector, is_centered, min_detect_width
+from .preview import Preview
+from .archive import SessionArchiver
+from .shutdown import ShutdownCoordinator, finisher
+from .logger import EventLogger
@@ -0,0 +1,275 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+from queue import Queue
+import hashlib
+import zipfile
+import zlib
+import time
+import os
+
+from typing import *
+
+
+# Already compressed, so deflating them only burns CPU; raw video is stored too, as deflate cannot keep up with it
+STORED_EXTENSIONS = {".mp4", ".avi", ".mkv", ".mjpeg", ".yuv", ".rgb", ".zip", ".mp3", ".png", ".jpg"}
+MANIFEST = "checksums.sha256"
+CHUNK = 1 << 20
+
+
+class Member(NamedTuple):
+    arcname: str
+    data: bytes  # raw deflate stream
+    crc: int
+    size: int
+    sha256: str
+    mtime: float
+
+
+def deflate_file(path: str, arcname: str, level: int = 6) -> Member:
+    """
+    Compress a file into a raw deflate stream, computing its CRC-32 and SHA-256 on the way.
+    zlib releases the GIL, so several files compress in parallel on a thread pool.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    sha256 = hashlib.sha256()
+    crc = 0
+    size = 0
+    chunks = []
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            sha256.update(chunk)
+            size += len(chunk)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return Member(arcname, b"".join(chunks), crc, size, sha256.hexdigest(), os.path.getmtime(path))
+
+
+# `write_deflated` appends precompressed data through `zipfile.ZipFile` internals, as the public API can only
+# compress on the calling thread: `fp`, `start_dir`, `filelist`, `NameToInfo`, `_didModify` and
+# `ZipInfo.FileHeader(zip64)`. Relied upon for Python 3.9 (the README target) to 3.13; tests/test_archive.py
+# checks them on the running version. Without them, members are written through `writestr` instead.
+def can_write_deflated(archive: zipfile.ZipFile) -> bool:
+    return (all(hasattr(archive, name) for name in ("fp", "start_dir", "filelist", "NameToInfo", "_didModify"))
+            and hasattr(zipfile.ZipInfo, "FileHeader") and not getattr(archive, "_writing", False))
+
+
+def write_deflated(archive: zipfile.ZipFile, member: Member):
+    """
+    Append an already deflated member to an archive opened for writing.
+    """
+    zinfo = zipfile.ZipInfo(member.arcname, time.localtime(member.mtime)[:6])
+    zinfo.external_attr = 0o644 << 16
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    if not can_write_deflated(archive):  # Recompresses, but only through the public API
+        archive.writestr(zinfo, zlib.decompress(member.data, -15))
+        return
+    zinfo.CRC = member.crc
+    zinfo.file_size = member.size
+    zinfo.compress_size = len(member.data)
+    zip64 = max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+
+    archive.fp.seek(archive.start_dir)
+    zinfo.header_offset = archive.start_dir
+    archive.fp.write(zinfo.FileHeader(zip64))
+    archive.fp.write(member.data)
+    archive.start_dir = archive.fp.tell()
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+    archive._didModify = True
+
+
+def write_stored(archive: zipfile.ZipFile, path: str, arcname: str, progress: Callable[[int], None]) -> str:
+    """
+    Copy a file into the archive without compression, computing its SHA-256 on the way.
+
+    :param progress: called with the number of bytes copied per chunk
+    :return: SHA-256 hex digest
+    """
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    zinfo.compress_type = zipfile.ZIP_STORED
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as src, archive.open(zinfo, 'w', force_zip64=zinfo.file_size > zipfile.ZIP64_LIMIT) as dst:
+        while True:
+            chunk = src.read(CHUNK)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            dst.write(chunk)
+            progress(len(chunk))
+    return sha256.hexdigest()
+
+
+class SessionArchiver(Thread):
+    """
+    Build `<output_name>.zip` of a session directory, with the layout of `shutil.make_archive(output_name, 'zip',
+    base_path)`, while the session runs.
+
+    Started at the beginning of the session, it appends files handed to `add` as soon as they are complete
+    (finished video segments, logs of a closed phase). `finish` then packs everything else under `base_path`:
+    media is stored as it is, text and binary logs are deflated in parallel on `workers` threads,
+    and a `checksums.sha256` manifest (`sha256sum` format) is added last. The archive is written as
+    `<output_name>.zip.part` and renamed when complete.
+
+    :param progress: called on the archiver thread with (bytes done, bytes total) while finishing
+    :param max_deflate_size: larger files are deflated on the archiver thread while streaming, not in memory
+    """
+    def __init__(self, base_path: str, output_name: str, workers: Optional[int] = None,
+                 progress: Optional[Callable[[int, int], None]] = None, level: int = 6,
+                 max_deflate_size: int = 256 << 20):
+        super().__init__(daemon=True)
+        self.base_path = base_path
+        self.path = output_name + ".zip"
+        self.workers = workers or os.cpu_count() or 1
+        self.progress = progress
+        self.level = level
+        self.max_deflate_size = max_deflate_size
+        self.jobs = Queue()
+        self.lock = Lock()
+        self.queued: Set[str] = set()
+        self.checksums: Dict[str, str] = {}
+        self.error: Optional[Exception] = None
+        self.finish_time = None
+        self.elapsed = 0.  # Time spent after `finish`
+        self.incremental = 0  # Files added before `finish`
+        self.done = 0
+        self.total = 0
+
+    def arcname(self, path: str) -> str:
+        return os.path.relpath(path, self.base_path).replace(os.sep, "/")
+
+    def files(self) -> List[Tuple[str, str]]:
+        """
+        :return: (path, arcname) of every file under `base_path`
+        """
+        files = []
+        for root, dirs, names in os.walk(self.base_path):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                files.append((path, self.arcname(path)))
+        return files
+
+    def add(self, paths: Iterable[str]):
+        """
+        Append complete files to the archive in the background. They must not change afterwards.
+        Thread-safe; files already added are skipped.
+        """
+        for path in paths:
+            arcname = self.arcname(path)
+            with self.lock:
+                if arcname in self.queued or self.finish_time is not None:
+                    continue
+                self.queued.add(arcname)
+            self.jobs.put((path, arcname))
+
+    def finish(self):
+        """
+        Pack the remaining files and close the archive; `join` waits for it.
+        """
+        with self.lock:
+            self.finish_time = time.perf_counter()
+        self.jobs.put(None)
+
+    def advance(self, n: int):
+        self.done += n
+        if self.progress is not None:
+            self.progress(self.done, self.total)
+
+    def run(self) -> None:
+        try:
+            self.archive()
+        except Exception as e:
+            self.error = e
+        if self.finish_time is not None:
+            self.elapsed = time.perf_counter() - self.finish_time
+
+    def archive(self):
+        part = self.path + ".part"
+        with zipfile.ZipFile(part, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                path, arcname = job
+                if not os.path.isfile(path):
+                    continue
+                if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+                    self.checksums[arcname] = write_stored(archive, path, arcname, lambda n: None)
+                else:
+                    member = deflate_file(path, arcname, self.level)
+                    write_deflated(archive, member)
+                    self.checksums[arcname] = member.sha256
+                self.incremental += 1
+
+            self.pack(archive, [(p, a) for p, a in self.files() if a not in self.checksums])
+            archive.writestr(MANIFEST, "".join("%s  %s\n" % (self.checksums[arcname], arcname)
+                                               for arcname in sorted(self.checksums)))
+        os.replace(part, self.path)
+
+    def pack(self, archive: zipfile.ZipFile, files: List[Tuple[str, str]]):
+        self.total = sum(os.path.getsize(path) for path, _ in files)
+        stored, deflated, streamed = [], [], []
+        for path, arcname in files:
+            if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+                stored.append((path, arcname))
+            elif os.path.getsize(path) > self.max_deflate_size:
+                streamed.append((path, arcname))
+            else:
+                deflated.append((path, arcname))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # Logs compress on the pool while media is copied
+            futures = [pool.submit(deflate_file, path, arcname, self.level) for path, arcname in deflated]
+            for path, arcname in stored:
+                self.checksums[arcname] = write_stored(archive, path, arcname, self.advance)
+            for future in futures:
+                member = future.result()
+                write_deflated(archive, member)
+                self.checksums[member.arcname] = member.sha256
+                self.advance(member.size)
+            for path, arcname in streamed:
+                self.checksums[arcname] = file_sha256(path)
+                archive.write(path, arcname, compress_type=zipfile.ZIP_DEFLATED)
+                self.advance(os.path.getsize(path))
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def verify(path: str) -> List[str]:
+    """
+    Check the members of an archive against its manifest.
+
+    :return: names of the members that are missing or do not match
+    """
+    failed = []
+    with zipfile.ZipFile(path) as archive:
+        manifest = archive.read(MANIFEST).decode('UTF-8')
+        for line in manifest.splitlines():
+            digest, arcname = line.split("  ", 1)
+            sha256 = hashlib.sha256()
+            try:
+                with archive.open(arcname) as f:
+                    while True:
+                        chunk = f.read(CHUNK)
+                        if not chunk:
+                            break
+                        sha256.update(chunk)
+            except KeyError:
+                failed.append(arcname)
+                continue
+            if sha256.hexdigest() != digest:
+                failed.append(arcname)
+    return failed
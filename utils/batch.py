@@ -0,0 +1,166 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import tempfile
+import zipfile
+import shutil
+import json
+import time
+import os
+
+from typing import *
+
+from utils.session import Session
+from utils import features
+
+
+class Shard(NamedTuple):
+    session: str  # session directory or archive
+    name: str  # session name
+    start: int  # first frame
+    stop: int  # frame to stop before
+    output: str  # feature file of the shard
+
+    @property
+    def checkpoint(self) -> str:
+        return self.output + ".done"
+
+
+def plan_shards(sessions: Iterable[str], out_dir: str, shard_frames: int = 9000,
+                extension: str = "parquet") -> List[Shard]:
+    """
+    Split sessions into shards of at most `shard_frames` frames, written to `<out_dir>/<session>/<start>-<stop>.<ext>`.
+    Frame counts come from the video timelines, so planning never decodes video.
+    """
+    shards = []
+    for path in sessions:
+        with Session(path) as session:
+            n = session.frame_count()
+            name = session.name
+        for start in range(0, n, shard_frames):
+            stop = min(n, start + shard_frames)
+            output = os.path.join(out_dir, name, "%08d-%08d.%s" % (start, stop, extension))
+            shards.append(Shard(path, name, start, stop, output))
+    return shards
+
+
+def is_done(shard: Shard) -> bool:
+    return os.path.isfile(shard.checkpoint) and os.path.isfile(shard.output)
+
+
+def extract_archives(shards: Iterable[Shard]) -> Dict[str, str]:
+    """
+    Extract every session archive the shards read into a temporary directory, once for all workers.
+
+    :return: extracted directory per archive path; the caller removes them
+    """
+    extracted = {}
+    try:
+        for shard in shards:
+            if shard.session in extracted or not os.path.isfile(shard.session):
+                continue
+            tmp = tempfile.mkdtemp(prefix="batch_%s_" % shard.name)
+            extracted[shard.session] = tmp
+            with zipfile.ZipFile(shard.session) as archive:
+                archive.extractall(tmp)
+    except BaseException:
+        for tmp in extracted.values():
+            shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return extracted
+
+
+# Per-process state of a worker, set up once by `init_worker`.
+# Sessions are directories here (archives are extracted by the parent), so they hold nothing to clean up.
+_extractor: Optional[features.LandmarkExtractor] = None
+_sessions: Dict[str, Session] = {}
+
+
+def init_worker(predictor_path: str, detector: str, detector_options: dict, detect_width: int, detect_every: int):
+    """
+    Pool initializer: every worker process loads its own detector and landmark model once.
+    """
+    global _extractor
+    from utils.face import make_detector
+    _extractor = features.LandmarkExtractor(predictor_path, make_detector(detector, **detector_options),
+                                            detect_width, detect_every)
+
+
+def run_shard(shard: Shard, source: Optional[str] = None, chunk: int = 1024) -> Tuple[Shard, int, float, int]:
+    """
+    Extract the features of one shard. The output is written under a temporary name and renamed once complete,
+    then a checkpoint records the shard, so an interrupted shard is redone from its start on resume.
+
+    :param source: directory to read the session from instead of `shard.session`, e.g. its extracted archive
+    :return: (shard, frames, seconds, worker pid)
+    """
+    source = source or shard.session
+    session = _sessions.get(source)
+    if session is None:
+        session = _sessions[source] = Session(source)
+
+    os.makedirs(os.path.dirname(shard.output), exist_ok=True)
+    root, extension = os.path.splitext(shard.output)
+    tmp = root + ".tmp" + extension
+    _extractor.tracker.reset()
+
+    start = time.perf_counter()
+    writer = features.FeatureWriter(tmp, chunk)
+    try:
+        n = features.extract_session(session, _extractor, writer, shard.start, shard.stop)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+
+    os.replace(tmp, shard.output)
+    with open(shard.checkpoint, 'w', encoding='UTF-8') as f:
+        json.dump({"session": shard.session, "start": shard.start, "stop": shard.stop,
+                   "frames": n, "seconds": elapsed, "pid": os.getpid()}, f)
+    return shard, n, elapsed, os.getpid()
+
+
+def run_batch(shards: List[Shard], workers: Optional[int] = None, predictor_path: str = features.PREDICTOR_PATH,
+              detector: str = "hog", detector_options: Optional[dict] = None,
+              detect_width: int = features.DETECT_WIDTH,
+              detect_every: int = 1, report: Callable[[str], None] = print) -> Dict[int, Tuple[int, float]]:
+    """
+    Run the shards that have no checkpoint yet on a process pool.
+    Session archives are extracted once up front and removed when the batch ends, however it ends.
+
+    :param workers: number of processes (default: one per core)
+    :param detector_options: `make_detector` options (default: `features.detector_options(detector)`)
+    :param report: receives one progress line per finished shard
+    :return: frames and busy seconds per worker pid
+    """
+    pending = [shard for shard in shards if not is_done(shard)]
+    report("batch,%d shards,%d done,%d pending" % (len(shards), len(shards) - len(pending), len(pending)))
+
+    stats: Dict[int, Tuple[int, float]] = {}
+    start = time.perf_counter()
+    total = 0
+    extracted = extract_archives(pending)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(predictor_path, detector,
+                                           detector_options if detector_options is not None
+                                           else features.detector_options(detector),
+                                           detect_width, detect_every)) as pool:
+            futures = [pool.submit(run_shard, shard, extracted.get(shard.session)) for shard in pending]
+            for future in as_completed(futures):
+                try:
+                    shard, n, elapsed, pid = future.result()
+                except Exception as e:
+                    report("batch,error,%s" % e)
+                    continue
+                frames, busy = stats.get(pid, (0, 0.))
+                stats[pid] = (frames + n, busy + elapsed)
+                total += n
+                report("shard,%s,%d-%d,%d frames,%.1f frames/s,worker %d" % (
+                    shard.name, shard.start, shard.stop, n, n / max(elapsed, 1e-9), pid))
+    finally:
+        for tmp in extracted.values():
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    wall = time.perf_counter() - start
+    for pid, (frames, busy) in sorted(stats.items()):
+        report("worker,%d,%d frames,%.1f frames/s" % (pid, frames, frames / max(busy, 1e-9)))
+    report("batch,%d frames,%.1f frames/s" % (total, total / max(wall, 1e-9)))
+    return stats
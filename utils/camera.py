@@ -1,35 +1,246 @@
 import cv2
+from threading import Thread, Lock
+from queue import Queue, Empty
+import json
+import time
 import os, sys
 
+from typing import *
 
-def select_camera(path="test.png"):
-    port_list = []
-    for i in range(10):
-        if sys.platform == "darwin":
-            cap = cv2.VideoCapture(i)
-        else:
-            cap = cv2.VideoCapture(i, cv2.CAP_DSHOW)
-        try:
-            success = 0
-            if cap.isOpened():
-                for _ in range(5):
-                    ret, frame = cap.read()
-                    if ret is True or frame is not None:
-                        cv2.imwrite(path, frame)
-                        success += 1
-                    cv2.waitKey(1)
-            if success == 5:
-                port_list.append(i)
-        finally:
-            cap.release()
-            cv2.destroyAllWindows()
 
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".online_experiment_camera.json")
+
+# (width, height, FOURCC) in order of preference; 'YUY2' is the DirectShow name of YUYV
+CANDIDATE_MODES = [
+    (640, 480, "MJPG"),
+    (640, 480, "YUY2"),
+    (1280, 720, "MJPG"),
+    (1280, 720, "YUY2"),
+]
+
+
+class CameraMode(NamedTuple):
+    width: int
+    height: int
+    fourcc: str
+    fps: float  # delivered frames per second
+    latency: float  # mean wall time spent in `read()`, in seconds
+    cpu: float  # mean CPU time spent in `read()` (decoding/conversion), in seconds
+
+    def __str__(self):
+        return "%d,%d,%s,%.1f,%.2f,%.2f" % (self.width, self.height, self.fourcc, self.fps,
+                                            self.latency * 1000, self.cpu * 1000)
+
+
+def default_api() -> int:
+    if sys.platform == "darwin":
+        return cv2.CAP_ANY
+    else:
+        return cv2.CAP_DSHOW
+
+
+# Devices left open by `select_camera`, handed over by the next `open_camera` of the same index
+opened: Dict[int, cv2.VideoCapture] = {}
+
+
+def open_camera(index: int, api: Optional[int] = None) -> cv2.VideoCapture:
+    cap = opened.pop(index, None)
+    if cap is not None and cap.isOpened():
+        return cap
+    return cv2.VideoCapture(index, default_api() if api is None else api)
+
+
+def probe_port(index: int, api: int, frames: int = 5) -> Optional[cv2.VideoCapture]:
+    """
+    :return: the opened device if the port delivers `frames` consecutive frames, otherwise None
+    """
+    cap = cv2.VideoCapture(index, api)
+    try:
+        if cap.isOpened():
+            for _ in range(frames):
+                ret, frame = cap.read()
+                if not ret or frame is None:
+                    break
+            else:
+                return cap
+    except Exception:
+        pass
+    cap.release()
+    return None
+
+
+def load_cache(cache_path: str) -> Optional[Tuple[int, int]]:
     try:
-        os.remove(path)
+        with open(cache_path, 'r', encoding='UTF-8') as f:
+            cache = json.load(f)
+        return int(cache["index"]), int(cache["api"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_cache(cache_path: str, index: int, api: int):
+    try:
+        with open(cache_path, 'w', encoding='UTF-8') as f:
+            json.dump({"index": index, "api": api}, f)
     except OSError:
         pass
 
-    if len(port_list) == 0:
+
+def select_camera(ports: Iterable[int] = range(10), timeout: float = 3.0,
+                  cache_path: Optional[str] = CACHE_PATH) -> Optional[int]:
+    """
+    Find a working camera. The camera of the previous run is tried first;
+    otherwise every port is probed concurrently on daemon threads.
+    The lowest working port is returned as soon as every lower port has failed,
+    and ports that have not answered within `timeout` seconds are abandoned.
+    The selected device stays open and is handed to the next `open_camera` call.
+
+    :param ports: candidate camera indices
+    :param timeout: deadline for every port, in seconds
+    :param cache_path: where the last working index and backend are kept (None to disable)
+    :return: camera index, or None if no camera works
+    """
+    api = default_api()
+
+    if cache_path is not None:
+        cached = load_cache(cache_path)
+        if cached is not None and cached[1] == api:
+            cap = probe_port(*cached)
+            if cap is not None:
+                opened[cached[0]] = cap
+                return cached[0]
+
+    ports = list(ports)
+    results = Queue()
+    lock = Lock()
+    done = False
+
+    def run(index):
+        cap = probe_port(index, api)
+        with lock:
+            if done:  # Answered after the selection
+                if cap is not None:
+                    cap.release()
+                return
+            results.put((index, cap))
+
+    for index in ports:
+        Thread(target=run, args=(index,), daemon=True).start()
+
+    deadline = time.monotonic() + timeout
+    status: Dict[int, Optional[cv2.VideoCapture]] = {}
+    selected = None
+    while len(status) < len(ports):
+        try:
+            index, cap = results.get(timeout=max(0., deadline - time.monotonic()))
+        except Empty:
+            break
+        status[index] = cap
+
+        # Prefer the lowest index, as the sequential scan did
+        for port in ports:
+            if port not in status:
+                break
+            if status[port] is not None:
+                selected = port
+                break
+        if selected is not None:
+            break
+
+    with lock:
+        done = True
+    while not results.empty():
+        index, cap = results.get()
+        status[index] = cap
+
+    if selected is None:
+        working = [port for port in ports if status.get(port) is not None]
+        selected = working[0] if working else None
+
+    for index, cap in status.items():
+        if cap is None:
+            continue
+        if index == selected:
+            opened[index] = cap
+        else:
+            cap.release()
+
+    if selected is not None and cache_path is not None:
+        save_cache(cache_path, selected, api)
+    return selected
+
+
+def get_fourcc(cap: cv2.VideoCapture) -> str:
+    code = int(cap.get(cv2.CAP_PROP_FOURCC))
+    return "".join(chr((code >> 8 * i) & 0xFF) for i in range(4))
+
+
+def apply_mode(cap: cv2.VideoCapture, width: int, height: int, fourcc: Optional[str] = None, fps: float = 30):
+    """
+    Request a capture mode. Drivers may silently substitute another one, so read the result back.
+
+    :return: (width, height, fourcc) actually delivered
+    """
+    if fourcc is not None:
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    cap.set(cv2.CAP_PROP_FPS, fps)
+    return int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), get_fourcc(cap)
+
+
+def measure_mode(cap: cv2.VideoCapture, frames: int = 15, warmup: int = 3) -> Tuple[float, float, float]:
+    """
+    :return: (delivered fps, mean read latency, mean read CPU time), (0, inf, inf) if the mode fails
+    """
+    for _ in range(warmup):
+        if not cap.read()[0]:
+            return 0., float('inf'), float('inf')
+
+    latency = 0.
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    for _ in range(frames):
+        t = time.perf_counter()
+        if not cap.read()[0]:
+            return 0., float('inf'), float('inf')
+        latency += time.perf_counter() - t
+    cpu = time.thread_time() - cpu_start
+    elapsed = time.perf_counter() - start
+    return frames / elapsed, latency / frames, cpu / frames
+
+
+def probe_modes(cap: cv2.VideoCapture, candidates=CANDIDATE_MODES, target_fps: float = 30,
+                frames: int = 15) -> List[CameraMode]:
+    """
+    Measure every candidate (width, height, FOURCC) on an open capture device.
+    Modes the driver substitutes are reported as delivered and measured once.
+    """
+    modes = []
+    seen = set()
+    for width, height, fourcc in candidates:
+        actual = apply_mode(cap, width, height, fourcc, target_fps)
+        if actual in seen:
+            continue
+        seen.add(actual)
+        modes.append(CameraMode(actual[0], actual[1], actual[2], *measure_mode(cap, frames)))
+    return modes
+
+
+def negotiate_mode(cap: cv2.VideoCapture, candidates=CANDIDATE_MODES, target_fps: float = 30,
+                   tolerance: float = 0.9, frames: int = 15) -> Optional[CameraMode]:
+    """
+    Pick the cheapest mode (lowest CPU time per frame) that sustains `target_fps` within `tolerance`,
+    or the fastest mode if none does, and leave the device in that mode.
+    """
+    modes = [mode for mode in probe_modes(cap, candidates, target_fps, frames) if mode.fps > 0]
+    if len(modes) == 0:
         return None
+
+    sustained = [mode for mode in modes if mode.fps >= target_fps * tolerance]
+    if len(sustained) > 0:
+        mode = min(sustained, key=lambda m: (m.cpu, m.width * m.height))
     else:
-        return port_list[0]
+        mode = max(modes, key=lambda m: m.fps)
+    apply_mode(cap, mode.width, mode.height, mode.fourcc, target_fps)
+    return mode
@@ -0,0 +1,88 @@
+import cv2
+
+from threading import Thread, Event, Lock
+import itertools
+import time
+
+from typing import *
+
+from utils.metrics import Registry, REGISTRY
+
+
+FrameCallback = Callable[[Any, Tuple[int, int, float]], None]
+
+
+class CaptureService(Thread):
+    """
+    Owns a capture device for the whole session and fans every frame out to subscribers
+    (camera preview, `VideoRecorder`, ...), so the device is opened once and consumers can switch without a gap.
+
+    Subscribers are called on the capture thread with `(frame, (monotonic_ns, wall_ns, pos_msec))`.
+    They must return quickly and must not modify the frame, which is shared between all of them.
+
+    :param metrics: registry receiving `capture.read_ms`, `capture.failures` and `capture.callback_errors`
+    :param log: receives a line per subscriber error, e.g. `ExpApp.log`
+    """
+    def __init__(self, cap: cv2.VideoCapture, metrics: Optional[Registry] = None, log: Callable[[str], None] = print):
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.log = log
+        self.subscribers: Dict[int, FrameCallback] = {}
+        self.tokens = itertools.count()
+        self.lock = Lock()
+        self.stopped = Event()
+        self.frames = 0
+        self.failures = 0
+        metrics = metrics if metrics is not None else REGISTRY
+        self.read_time = metrics.histogram("capture.read_ms")
+        self.failure_count = metrics.counter("capture.failures")
+        self.callback_errors = metrics.counter("capture.callback_errors")
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def subscribe(self, callback: FrameCallback) -> int:
+        """
+        :return: token for `unsubscribe`
+        """
+        with self.lock:
+            token = next(self.tokens)
+            self.subscribers[token] = callback
+        return token
+
+    def unsubscribe(self, token: int):
+        with self.lock:
+            self.subscribers.pop(token, None)
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            start = time.monotonic_ns()
+            ret, frame = self.cap.read()
+            stamp = (time.monotonic_ns(), time.time_ns(), self.cap.get(cv2.CAP_PROP_POS_MSEC))
+            self.read_time.observe((stamp[0] - start) / 1e6)
+            if not ret or frame is None:
+                self.failures += 1
+                self.failure_count.inc()
+                time.sleep(0.01)
+                continue
+            self.frames += 1
+
+            with self.lock:
+                subscribers = list(self.subscribers.values())
+            for callback in subscribers:
+                try:
+                    callback(frame, stamp)
+                except Exception as e:
+                    self.callback_errors.inc()
+                    self.log("captureService,%s" % e)
+
+    def stop(self, timeout=None):
+        """
+        Stop capturing and release the device.
+        """
+        self.stopped.set()
+        if self.is_alive():
+            self.join(timeout=timeout)
+        if not self.is_alive():
+            self.cap.release()
@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+import re
+import os
+
+from typing import *
+
+from utils.session import Session
+
+
+class Probe(NamedTuple):
+    log: str  # probe log name, e.g. 'waiting' for probe_waiting.txt
+    number: int  # position of the sound in the log
+    sound_t: float  # time of the ding
+    response_t: float  # time of the answer, NaN without one
+    answer: str  # 'y', 'n' or '' without one
+
+
+def parse_probe_log(f: IO[str], log: str) -> List[Probe]:
+    """
+    Join every `sound` line of a `probe_<name>.txt` with the `probe` line answering it.
+    `ProbeRunner` writes the answer with the time of its sound, so the join is exact.
+    """
+    sounds = []
+    answers = {}
+    for line in f:
+        fields = line.strip().split(",")
+        if len(fields) == 2 and fields[1] == "sound":
+            sounds.append(float(fields[0]))
+        elif len(fields) == 4 and fields[2] == "probe":
+            answers[fields[0]] = (float(fields[1]), fields[3])
+    probes = []
+    for number, t in enumerate(sounds):
+        response_t, answer = answers.get("%f" % t, (float('nan'), ""))
+        probes.append(Probe(log, number, t, response_t, answer))
+    return probes
+
+
+def load_session_probes(session: Session) -> List[Probe]:
+    """
+    :return: the probes of every `probe_<name>.txt` of the session, in time order
+    """
+    probes = []
+    for name in session.names():
+        match = re.fullmatch(r"probe_(.+)\.txt", name)
+        if match is not None:
+            with session.open(name) as f:
+                probes.extend(parse_probe_log(f, match.group(1)))
+    return sorted(probes, key=lambda p: p.sound_t)
+
+
+class Clip(NamedTuple):
+    probe: Probe
+    start: int  # first session frame
+    stop: int  # session frame to stop before
+
+
+def index_clips(timeline: np.ndarray, probes: Iterable[Probe], seconds: float) -> List[Clip]:
+    """
+    Map the `seconds` before every probe onto session frame ranges with binary searches over the timeline.
+    """
+    clips = []
+    for probe in probes:
+        start = int(np.searchsorted(timeline, probe.sound_t - seconds, side='left'))
+        stop = int(np.searchsorted(timeline, probe.sound_t, side='left'))
+        clips.append(Clip(probe, start, stop))
+    return clips
+
+
+def clip_name(session: Session, clip: Clip) -> str:
+    return "%s_%s_%03d_%s" % (session.name, clip.probe.log, clip.probe.number, clip.probe.answer or "none")
+
+
+def write_clip(session: Session, clip: Clip, out_dir: str, fmt: str = "mp4", width: Optional[int] = None) -> Tuple[str, int]:
+    """
+    Seek to the first frame of the clip and write its frames as a video (`mp4`) or a `npz` of
+    `frames`, `timestamps` and the probe label.
+
+    :param width: downscale frames to this width
+    :return: (output path, frames written)
+    """
+    path = os.path.join(out_dir, "%s.%s" % (clip_name(session, clip), fmt))
+    writer = None
+    frames = []
+    times = []
+    try:
+        for frame_idx, t, frame in session.frames(clip.start, clip.stop):
+            if width is not None and frame.shape[1] != width:
+                frame = cv2.resize(frame, (width, int(frame.shape[0] * width / frame.shape[1])),
+                                   interpolation=cv2.INTER_AREA)
+            times.append(t)
+            if fmt == "npz":
+                frames.append(frame)
+                continue
+            if writer is None:
+                # Frame rate the camera actually delivered over the window
+                fps = (clip.stop - clip.start) / max(clip.probe.sound_t - t, 1e-3)
+                writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), min(60., max(1., fps)),
+                                         (frame.shape[1], frame.shape[0]))
+            writer.write(frame)
+    finally:
+        if writer is not None:
+            writer.release()
+    if fmt == "npz":
+        np.savez(path, frames=np.array(frames), timestamps=np.array(times), answer=clip.probe.answer,
+                 sound_t=clip.probe.sound_t, response_t=clip.probe.response_t)
+    return path, len(times)
+
+
+def extract_clips(session: Session, clips: List[Clip], out_dir: str, fmt: str = "mp4", width: Optional[int] = None,
+                  workers: int = 4) -> List[Tuple[Clip, str, int]]:
+    """
+    Write the clips on a thread pool; every clip opens its own reader and seeks directly to its range,
+    and OpenCV decodes without holding the GIL.
+
+    :return: (clip, output path, frames) for every clip, in the order given
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for segment in session.segments():  # Extract archive members once, before the threads need them
+        session.local_path(segment["video"])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda clip: write_clip(session, clip, out_dir, fmt, width), clips))
+    return [(clip, path, n) for clip, (path, n) in zip(clips, results)]
@@ -0,0 +1,201 @@
+import numpy as np
+import cv2
+
+import subprocess
+import functools
+import shutil
+import json
+import time
+
+from typing import *
+
+
+class Encoder:
+    """
+    Base class of the video backends used by `VideoRecorder`.
+    It mimics `cv2.VideoWriter` (`write`, `release`) and measures the time spent in every `write`.
+    """
+    extension = "mp4"
+    configures_capture = False  # `configure_capture` changes the device, so the encoder needs its own
+
+    def __init__(self):
+        self.path = None
+        self.frames = 0
+        self.encode_time = 0.
+        self.last_encode_time = 0.
+
+    @property
+    def mean_encode_time(self) -> float:
+        return self.encode_time / self.frames if self.frames > 0 else 0.
+
+    def configure_capture(self, cap: cv2.VideoCapture):
+        """
+        Called on the capture device before the frame size is queried.
+        """
+        pass
+
+    def open(self, path: str, size: Tuple[int, int], fps: float):
+        self.path = path
+
+    def write(self, frame: np.ndarray):
+        start = time.perf_counter()
+        self.encode(frame)
+        self.last_encode_time = time.perf_counter() - start
+        self.encode_time += self.last_encode_time
+        self.frames += 1
+
+    def encode(self, frame: np.ndarray):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+
+class OpenCVEncoder(Encoder):
+    """
+    `cv2.VideoWriter` with the given FOURCC, e.g. 'mpeg' (default recording) or 'FFV1' (lossless).
+    """
+    def __init__(self, fourcc: str = "mpeg", extension: str = "mp4"):
+        super().__init__()
+        self.fourcc = fourcc
+        self.extension = extension
+        self.video_out = None
+
+    def open(self, path, size, fps):
+        super().open(path, size, fps)
+        self.video_out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*self.fourcc), fps, size)
+        if not self.video_out.isOpened():
+            raise RuntimeError("OpenCV cannot encode %s into %s" % (self.fourcc, path))
+
+    def encode(self, frame):
+        self.video_out.write(frame)
+
+    def release(self):
+        if self.video_out is not None:
+            self.video_out.release()
+
+
+class MJPGPassthroughEncoder(Encoder):
+    """
+    Store the compressed MJPG frames from the camera as they are (concatenated JPEGs, readable by ffmpeg/OpenCV).
+    The capture device is switched to MJPG with RGB conversion disabled, so frames are never decoded.
+    If the driver ignores it and delivers decoded frames, they are JPEG-encoded instead.
+    Only a recorder that owns the device can pass frames through; a shared `CaptureService` delivers decoded frames.
+    """
+    extension = "mjpeg"
+    configures_capture = True
+
+    def __init__(self, quality: int = 90):
+        super().__init__()
+        self.quality = quality
+        self.output = None
+        self.reencoded = 0
+
+    def configure_capture(self, cap):
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
+    def open(self, path, size, fps):
+        super().open(path, size, fps)
+        self.output = open(path, 'wb')
+
+    def encode(self, frame):
+        if frame.ndim == 3:
+            self.reencoded += 1
+            ret, frame = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ret:
+                return
+        self.output.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        if self.output is not None:
+            self.output.close()
+
+
+class RawEncoder(Encoder):
+    """
+    Uncompressed frames, either BGR24 or planar YUV 4:2:0 (I420).
+    A `<path>.json` sidecar keeps the geometry needed to read the file back.
+    """
+    def __init__(self, pix_fmt: str = "yuv420p"):
+        super().__init__()
+        if pix_fmt not in ("bgr24", "yuv420p"):
+            raise ValueError("Unsupported pixel format %s" % pix_fmt)
+        self.pix_fmt = pix_fmt
+        self.extension = "yuv" if pix_fmt == "yuv420p" else "rgb"
+        self.output = None
+
+    def open(self, path, size, fps):
+        super().open(path, size, fps)
+        with open(path + ".json", 'w', encoding='UTF-8') as f:
+            json.dump({"width": size[0], "height": size[1], "fps": fps, "pix_fmt": self.pix_fmt}, f)
+        self.output = open(path, 'wb')
+
+    def encode(self, frame):
+        if self.pix_fmt == "yuv420p":
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+        self.output.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        if self.output is not None:
+            self.output.close()
+
+
+class FFmpegPipeEncoder(Encoder):
+    """
+    Pipe raw BGR frames into an ffmpeg subprocess.
+    Encoding runs in the ffmpeg process, so the measured time is how long the pipe write blocks.
+    """
+    PRESETS = {
+        "h264-fast": (["-c:v", "libx264", "-preset", "ultrafast", "-crf", "23", "-pix_fmt", "yuv420p"], "mp4"),
+        "h264-small": (["-c:v", "libx264", "-preset", "veryfast", "-crf", "28", "-pix_fmt", "yuv420p"], "mp4"),
+        "ffv1": (["-c:v", "ffv1", "-level", "3", "-g", "1"], "mkv"),
+    }
+
+    def __init__(self, preset: str = "h264-fast", ffmpeg: str = "ffmpeg", extra_args: Optional[List[str]] = None):
+        super().__init__()
+        if preset not in self.PRESETS:
+            raise ValueError("Unknown ffmpeg preset %s" % preset)
+        self.args, self.extension = self.PRESETS[preset]
+        self.args = self.args + (extra_args or [])
+        self.ffmpeg = shutil.which(ffmpeg)
+        if self.ffmpeg is None:
+            raise RuntimeError("ffmpeg not found: %s" % ffmpeg)
+        self.proc = None
+
+    def open(self, path, size, fps):
+        super().open(path, size, fps)
+        cmd = [self.ffmpeg, "-loglevel", "error", "-y",
+               "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", "%dx%d" % size, "-r", str(fps), "-i", "-"]
+        self.proc = subprocess.Popen(cmd + self.args + [path], stdin=subprocess.PIPE)
+
+    def encode(self, frame):
+        self.proc.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self, timeout=10.0):
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        try:
+            self.proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+ENCODERS = {
+    "mpeg": functools.partial(OpenCVEncoder, "mpeg", "mp4"),
+    "ffv1": functools.partial(OpenCVEncoder, "FFV1", "avi"),
+    "mjpg": MJPGPassthroughEncoder,
+    "raw": RawEncoder,
+    "ffmpeg": FFmpegPipeEncoder,
+}
+
+
+def make_encoder(name: str, **kwargs) -> Encoder:
+    """
+    :param name: one of `ENCODERS`
+    :param kwargs: backend options, e.g. `preset` for 'ffmpeg' or `pix_fmt` for 'raw'
+    """
+    if name not in ENCODERS:
+        raise ValueError("Unknown encoder %s (available: %s)" % (name, ", ".join(ENCODERS)))
+    return ENCODERS[name](**kwargs)
@@ -0,0 +1,193 @@
+import numpy as np
+
+import struct
+import sys
+import os
+
+from typing import *
+
+from utils.records import load_records
+
+
+MAGIC = b'EVL1'
+VERSION = 1
+HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<dBBiihh')
+EVENT_DTYPE = np.dtype([
+    ('t', '<f8'),
+    ('kind', 'u1'),
+    ('button', 'u1'),
+    ('x', '<i4'),
+    ('y', '<i4'),
+    ('dx', '<i2'),
+    ('dy', '<i2'),
+])
+assert RECORD.size == EVENT_DTYPE.itemsize
+
+KIND_MOVE = 1
+KIND_CLICK_PRESS = 2
+KIND_CLICK_RELEASE = 3
+KIND_SCROLL = 4
+KIND_KEY_PRESS = 5
+KIND_KEY_RELEASE = 6
+
+BUTTONS = {"unknown": 0, "left": 1, "right": 2, "middle": 3, "x1": 4, "x2": 5}
+BUTTON_NAMES = {v: k for k, v in BUTTONS.items()}
+
+# Numpad keys have no character and are logged by virtual key code, e.g. `<97>`
+NUMPAD_VK = range(96, 106)
+
+
+def header() -> bytes:
+    return HEADER.pack(MAGIC, VERSION)
+
+
+def button_code(button) -> int:
+    return BUTTONS.get(getattr(button, "name", str(button)), 0)
+
+
+def key_code(key) -> int:
+    char = getattr(key, "char", None)
+    if char is not None:
+        return ord(char) & 0xFF
+    vk = getattr(key, "vk", None)
+    return vk & 0xFF if vk is not None else 0
+
+
+def clamp16(v: int) -> int:
+    return max(-32768, min(32767, v))
+
+
+def pack_event(record: tuple) -> bytes:
+    """
+    Pack an `ActivityRecorder` record, (kind, time, *fields), into one fixed-width binary record.
+    Usable as the formatter of a binary `utils.logwriter.BatchedWriter`.
+    """
+    kind, t = record[0], record[1]
+    if kind == "move":
+        x, y = record[2:]
+        return RECORD.pack(t, KIND_MOVE, 0, x, y, 0, 0)
+    elif kind == "click":
+        button, pressed, x, y = record[2:]
+        return RECORD.pack(t, KIND_CLICK_PRESS if pressed else KIND_CLICK_RELEASE, button_code(button), x, y, 0, 0)
+    elif kind == "scroll":
+        x, y, dx, dy = record[2:]
+        return RECORD.pack(t, KIND_SCROLL, 0, x, y, clamp16(dx), clamp16(dy))
+    elif kind == "press":
+        return RECORD.pack(t, KIND_KEY_PRESS, key_code(record[2]), 0, 0, 0, 0)
+    elif kind == "release":
+        return RECORD.pack(t, KIND_KEY_RELEASE, key_code(record[2]), 0, 0, 0, 0)
+    raise ValueError("Unknown event kind %s" % kind)
+
+
+def load_events(path: str) -> np.ndarray:
+    """
+    Memory-map a binary event log.
+
+    :return: structured array of `EVENT_DTYPE`
+    """
+    return load_records(path, MAGIC, EVENT_DTYPE, HEADER, VERSION)[1]
+
+
+def format_key(code: int) -> str:
+    if code in NUMPAD_VK:
+        return "<%d>" % code
+    return "'%s'" % chr(code)
+
+
+def format_event(event) -> str:
+    """
+    :return: the line `ActivityRecorder` writes for the same event in its text logs
+    """
+    t, kind = float(event['t']), int(event['kind'])
+    x, y = int(event['x']), int(event['y'])
+    if kind == KIND_MOVE:
+        return "%f,mouse,move,%d,%d\n" % (t, x, y)
+    elif kind in (KIND_CLICK_PRESS, KIND_CLICK_RELEASE):
+        button = "Button.%s" % BUTTON_NAMES.get(int(event['button']), "unknown")
+        return "%f,mouse,click,%s,%d,%d,%d\n" % (t, button, kind == KIND_CLICK_PRESS, x, y)
+    elif kind == KIND_SCROLL:
+        return "%f,mouse,scroll,%d,%d,%d,%d\n" % (t, x, y, int(event['dx']), int(event['dy']))
+    elif kind == KIND_KEY_PRESS:
+        return "%f,key,press,%s\n" % (t, format_key(int(event['button'])))
+    elif kind == KIND_KEY_RELEASE:
+        return "%f,key,release,%s\n" % (t, format_key(int(event['button'])))
+    raise ValueError("Unknown event kind %d" % kind)
+
+
+def convert_to_csv(path: str, out_path: Optional[str] = None, chunk: int = 65536) -> str:
+    """
+    Convert a binary event log to the text layout of `mouse_log_<name>.txt` / `keyboard_log_<name>.txt`.
+
+    :param out_path: defaults to `path` with a `.txt` extension
+    :return: out_path
+    """
+    if out_path is None:
+        out_path = os.path.splitext(path)[0] + ".txt"
+    events = load_events(path)
+    with open(out_path, 'w', encoding='UTF-8') as f:
+        for start in range(0, len(events), chunk):
+            f.write("".join(format_event(e) for e in events[start:start + chunk]))
+    return out_path
+
+
+PROBE_MAGIC = b'PRB1'
+PROBE_RECORD = struct.Struct('<ddc')
+PROBE_DTYPE = np.dtype([
+    ('probe_t', '<f8'),
+    ('response_t', '<f8'),
+    ('answer', 'S1'),
+])
+assert PROBE_RECORD.size == PROBE_DTYPE.itemsize
+
+
+class ProbeLog:
+    """
+    Append-only `probe_<name>.txt`. Every record is flushed and fsynced on its own,
+    so each write costs the same and a crash never leaves a truncated file behind.
+
+    :param binary_path: optional sidecar with one `PROBE_DTYPE` record per line of the text log;
+                        sound rows have a NaN `response_t` and a blank answer
+    """
+    def __init__(self, path: str, binary_path: Optional[str] = None):
+        self.output = open(path, 'a', encoding='UTF-8')
+        self.binary_output = None
+        if binary_path is not None:
+            self.binary_output = open(binary_path, 'ab')
+            if self.binary_output.tell() == 0:
+                self.binary_output.write(HEADER.pack(PROBE_MAGIC, VERSION))
+
+    def append(self, line: str, record: bytes):
+        self.output.write(line)
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        if self.binary_output is not None:
+            self.binary_output.write(record)
+            self.binary_output.flush()
+            os.fsync(self.binary_output.fileno())
+
+    def sound(self, t: float):
+        self.append("%f,sound\n" % t, PROBE_RECORD.pack(t, float('nan'), b' '))
+
+    def probe(self, probe_t: float, response_t: float, answer: str):
+        self.append("%f,%f,probe,%s\n" % (probe_t, response_t, answer),
+                    PROBE_RECORD.pack(probe_t, response_t, answer.encode()[:1]))
+
+    def close(self):
+        self.output.close()
+        if self.binary_output is not None:
+            self.binary_output.close()
+
+
+def load_probes(path: str) -> np.ndarray:
+    """
+    Memory-map a binary probe sidecar written by `ProbeLog`.
+
+    :return: structured array of `PROBE_DTYPE`
+    """
+    return load_records(path, PROBE_MAGIC, PROBE_DTYPE, HEADER, VERSION)[1]
+
+
+if __name__ == '__main__':
+    for arg in sys.argv[1:]:
+        print(convert_to_csv(arg))
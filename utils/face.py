@@ -0,0 +1,227 @@
+import numpy as np
+import cv2
+
+import time
+import os
+
+from typing import *
+
+
+Box = Tuple[int, int, int, int]  # (x, y, w, h)
+
+# dlib is imported where it is first needed: it is the most expensive import of the GUI process,
+# which loads this module at startup but only detects faces on the camera setup screen
+
+HOG_MIN_FACE = 80  # px, smallest face dlib's HOG detector finds without upsampling
+CENTERED_FRACTION = 0.2  # smallest face width accepted by `is_centered`, relative to the image width
+
+
+class FaceDetector:
+    """
+    Interchangeable CPU face detector.
+    `detect` receives the same image in color (channel order as captured) and grayscale,
+    and returns face boxes ordered from the most to the least confident.
+    """
+    name = "base"
+
+    def detect(self, img: np.ndarray, gray: np.ndarray) -> List[Box]:
+        raise NotImplementedError
+
+
+class HOGDetector(FaceDetector):
+    """
+    dlib HOG + linear SVM frontal face detector.
+    """
+    name = "hog"
+
+    def __init__(self, upsample: int = 0):
+        import dlib
+        self.detector = dlib.get_frontal_face_detector()
+        self.upsample = upsample
+
+    def detect(self, img, gray):
+        return [(r.left(), r.top(), r.width(), r.height()) for r in self.detector(gray, self.upsample)]
+
+
+class CNNDetector(FaceDetector):
+    """
+    dlib MMOD CNN detector. Needs `mmod_human_face_detector.dat` from dlib's model zoo.
+    """
+    name = "cnn"
+
+    def __init__(self, model: str = "mmod_human_face_detector.dat", upsample: int = 0):
+        import dlib
+        if not hasattr(dlib, "cnn_face_detection_model_v1"):
+            raise RuntimeError("dlib was built without the CNN face detector")
+        if not os.path.isfile(model):
+            raise RuntimeError("CNN face detector model not found: %s" % model)
+        self.detector = dlib.cnn_face_detection_model_v1(model)
+        self.upsample = upsample
+
+    def detect(self, img, gray):
+        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # dlib expects RGB
+        detections = sorted(self.detector(rgb, self.upsample), key=lambda d: -d.confidence)
+        return [(d.rect.left(), d.rect.top(), d.rect.width(), d.rect.height()) for d in detections]
+
+
+class DNNDetector(FaceDetector):
+    """
+    OpenCV `cv2.dnn` ResNet-10 SSD face detector (`deploy.prototxt` + `res10_300x300_ssd_iter_140000.caffemodel`).
+    """
+    name = "dnn"
+
+    def __init__(self, prototxt: str = "deploy.prototxt", model: str = "res10_300x300_ssd_iter_140000.caffemodel",
+                 confidence: float = 0.5, input_size: int = 300):
+        for path in (prototxt, model):
+            if not os.path.isfile(path):
+                raise RuntimeError("DNN face detector file not found: %s" % path)
+        self.net = cv2.dnn.readNetFromCaffe(prototxt, model)
+        self.confidence = confidence
+        self.input_size = input_size
+
+    def detect(self, img, gray):
+        h, w = img.shape[:2]
+        blob = cv2.dnn.blobFromImage(img, 1.0, (self.input_size, self.input_size), (104.0, 177.0, 123.0))
+        self.net.setInput(blob)
+        detections = self.net.forward()[0, 0]
+        detections = detections[detections[:, 2] >= self.confidence]
+        detections = detections[np.argsort(-detections[:, 2])]
+        boxes = []
+        for x1, y1, x2, y2 in detections[:, 3:7] * np.array([w, h, w, h]):
+            boxes.append((int(x1), int(y1), int(x2 - x1), int(y2 - y1)))
+        return boxes
+
+
+class HaarDetector(FaceDetector):
+    """
+    OpenCV Haar cascade, the cheapest and least robust backend.
+    """
+    name = "haar"
+
+    def __init__(self, cascade: Optional[str] = None, scale_factor: float = 1.1, min_neighbors: int = 5):
+        if cascade is None:
+            cascade = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
+        self.detector = cv2.CascadeClassifier(cascade)
+        if self.detector.empty():
+            raise RuntimeError("Haar cascade not found: %s" % cascade)
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+
+    def detect(self, img, gray):
+        faces = self.detector.detectMultiScale(gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors)
+        return sorted([tuple(int(v) for v in f) for f in faces], key=lambda b: -b[2] * b[3])
+
+
+DETECTORS = {
+    "hog": HOGDetector,
+    "cnn": CNNDetector,
+    "dnn": DNNDetector,
+    "haar": HaarDetector,
+}
+
+
+def make_detector(name: str, **kwargs) -> FaceDetector:
+    """
+    :param name: one of `DETECTORS`
+    :param kwargs: backend options, e.g. `upsample` for 'hog' or model paths for 'cnn'/'dnn'
+    """
+    if name not in DETECTORS:
+        raise ValueError("Unknown face detector %s (available: %s)" % (name, ", ".join(DETECTORS)))
+    return DETECTORS[name](**kwargs)
+
+
+def is_centered(box: Box, w: int, h: int) -> bool:
+    """
+    Alignment check of the camera setup screen: the face is at least a fifth of the image wide
+    and its center lies within that distance from the image center.
+    """
+    x, y, x_d, y_d = box
+    t_size = w * CENTERED_FRACTION  # target size
+    center = (x + int(x_d / 2), y + int(y_d / 2))
+    return x_d >= t_size and (center[0] - int(w / 2)) ** 2 + (center[1] - int(h / 2)) ** 2 < t_size ** 2
+
+
+def min_detect_width(face_fraction: float = CENTERED_FRACTION, upsample: int = 0) -> int:
+    """
+    Smallest detection width at which the HOG detector still finds faces `face_fraction` of the image wide,
+    e.g. 400 px for the faces `is_centered` accepts. Every upsampling step halves it.
+    """
+    return int(np.ceil(HOG_MIN_FACE / (face_fraction * 2 ** upsample)))
+
+
+class FaceTracker:
+    """
+    Face detection for the camera preview.
+    The detector (HOG without upsampling by default) runs on a downscaled copy, and only every `detect_every` frames;
+    a dlib correlation tracker follows the face in between.
+
+    :param detect_width: width of the copy the detector and tracker work on; by default the smallest at which
+                         HOG still finds every face `is_centered` accepts (see `min_detect_width`)
+    :param detect_every: run the detector on every Nth frame (1 disables tracking)
+    :param upsample: number of times the default HOG detector upsamples the image
+    :param detector: any `FaceDetector` instead of HOG
+    """
+    def __init__(self, detect_width: Optional[int] = None, detect_every: int = 5, upsample: int = 0,
+                 detector: Optional[FaceDetector] = None):
+        self.detector = detector if detector is not None else HOGDetector(upsample)
+        self.detect_width = detect_width if detect_width is not None else min_detect_width(upsample=upsample)
+        self.detect_every = detect_every
+        self.tracker = None  # dlib.correlation_tracker
+        self.frames = 0
+        self.detections = 0
+        self.detect_time = 0.
+        self.track_time = 0.
+        self.last_latency = 0.
+
+    @property
+    def mean_detect_time(self) -> float:
+        return self.detect_time / self.detections if self.detections > 0 else 0.
+
+    @property
+    def mean_track_time(self) -> float:
+        tracked = self.frames - self.detections
+        return self.track_time / tracked if tracked > 0 else 0.
+
+    def reset(self):
+        """
+        Forget the tracked face, e.g. after a seek; the next `update` runs the detector.
+        """
+        self.tracker = None
+
+    def update(self, img, color_conversion=cv2.COLOR_BGR2GRAY) -> Optional[Box]:
+        """
+        :param img: full-size frame
+        :param color_conversion: conversion of `img` to grayscale
+        :return: face bounding box (x, y, w, h) in `img` coordinates, or None
+        """
+        h, w = img.shape[:2]
+        scale = min(1., self.detect_width / w)
+        small = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, color_conversion) if small.ndim == 3 else small
+
+        start = time.perf_counter()
+        if self.tracker is None or self.frames % self.detect_every == 0:
+            boxes = self.detector.detect(small, gray)
+            if len(boxes) > 0:
+                import dlib
+                x, y, x_d, y_d = boxes[0]
+                rect = dlib.rectangle(x, y, x + x_d, y + y_d)
+                self.tracker = dlib.correlation_tracker()
+                self.tracker.start_track(gray, rect)
+            else:
+                rect = None
+                self.tracker = None
+            self.last_latency = time.perf_counter() - start
+            self.detect_time += self.last_latency
+            self.detections += 1
+        else:
+            self.tracker.update(gray)
+            rect = self.tracker.get_position()
+            self.last_latency = time.perf_counter() - start
+            self.track_time += self.last_latency
+        self.frames += 1
+
+        if rect is None:
+            return None
+        return (int(rect.left() / scale), int(rect.top() / scale),
+                int(rect.width() / scale), int(rect.height() / scale))
@@ -0,0 +1,238 @@
+from imutils import face_utils
+import numpy as np
+import dlib
+import cv2
+
+import struct
+import os
+
+from typing import *
+
+from utils.face import FaceTracker, FaceDetector
+from utils.records import load_records
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+PREDICTOR_PATH = "shape_predictor_68_face_landmarks.dat"
+
+# Detector setup of the original camera preview: offline extraction has no real-time budget,
+# so it keeps finding faces down to about 8% of the frame width
+DETECT_WIDTH = 500
+UPSAMPLE = 1
+
+
+def detector_options(name: str, upsample: int = UPSAMPLE) -> dict:
+    """
+    :return: `make_detector` options of the backend `name` for offline extraction
+    """
+    return {"upsample": upsample} if name in ("hog", "cnn") else {}
+
+
+FEATURE_DTYPE = np.dtype([
+    ('frame_idx', '<i8'),
+    ('timestamp', '<f8'),
+    ('face', 'u1'),
+    ('x', '<i4'),
+    ('y', '<i4'),
+    ('w', '<i4'),
+    ('h', '<i4'),
+    ('landmarks', '<f4', (68, 2)),
+    ('yaw', '<f4'),
+    ('pitch', '<f4'),
+    ('roll', '<f4'),
+    ('ear_left', '<f4'),
+    ('ear_right', '<f4'),
+])
+
+MAGIC = b'FTR1'
+VERSION = 1
+HEADER = struct.Struct('<4sI')
+
+# Generic 3D face model (mm, image axes: y down, z away from the camera)
+# for the nose tip, chin, eye outer corners and mouth corners
+MODEL_POINTS = np.array([
+    (0.0, 0.0, 0.0),
+    (0.0, 330.0, 65.0),
+    (-225.0, -170.0, 135.0),
+    (225.0, -170.0, 135.0),
+    (-150.0, 150.0, 125.0),
+    (150.0, 150.0, 125.0),
+], dtype=np.float64)
+MODEL_LANDMARKS = [30, 8, 36, 45, 48, 54]
+
+
+def eye_aspect_ratio(eye: np.ndarray) -> float:
+    """
+    Soukupova and Cech's eye aspect ratio of the six landmarks of one eye.
+    """
+    a = np.linalg.norm(eye[1] - eye[5])
+    b = np.linalg.norm(eye[2] - eye[4])
+    c = np.linalg.norm(eye[0] - eye[3])
+    return float((a + b) / (2.0 * c)) if c > 0 else 0.
+
+
+def head_pose(shape: np.ndarray, size: Tuple[int, int]) -> Tuple[float, float, float]:
+    """
+    Head orientation from the 68 landmarks, with the camera approximated by a pinhole of focal length = image width.
+
+    :param size: (width, height) of the frame
+    :return: (yaw, pitch, roll) in degrees, NaN if `solvePnP` fails
+    """
+    w, h = size
+    camera_matrix = np.array([[w, 0, w / 2], [0, w, h / 2], [0, 0, 1]], dtype=np.float64)
+    image_points = shape[MODEL_LANDMARKS].astype(np.float64)
+    ok, rvec, tvec = cv2.solvePnP(MODEL_POINTS, image_points, camera_matrix, np.zeros((4, 1)),
+                                  flags=cv2.SOLVEPNP_ITERATIVE)
+    if not ok:
+        return float('nan'), float('nan'), float('nan')
+    rotation, _ = cv2.Rodrigues(rvec)
+    angles = cv2.RQDecomp3x3(rotation)[0]
+    pitch, yaw, roll = angles
+    return float(yaw), float(pitch), float(roll)
+
+
+class LandmarkExtractor:
+    """
+    Per-frame face features: the face box from a `FaceTracker`, dlib's 68-point landmarks on the full-resolution
+    frame (as `imutils.face_utils` arrays), head pose and the eye aspect ratio of both eyes.
+
+    :param predictor_path: dlib `shape_predictor_68_face_landmarks.dat`
+    :param detector: face detector backend, dlib HOG upsampling `upsample` times by default
+    :param detect_width: width the detector works on
+    :param detect_every: run the detector on every Nth frame and track in between (1 detects on every frame)
+    """
+    def __init__(self, predictor_path: str = PREDICTOR_PATH, detector: Optional[FaceDetector] = None,
+                 detect_width: int = DETECT_WIDTH, detect_every: int = 1, upsample: int = UPSAMPLE):
+        if not os.path.isfile(predictor_path):
+            raise RuntimeError("Landmark model not found: %s" % predictor_path)
+        self.predictor = dlib.shape_predictor(predictor_path)
+        self.tracker = FaceTracker(detect_width=detect_width, detect_every=detect_every, upsample=upsample,
+                                   detector=detector)
+        self.left_eye = slice(*face_utils.FACIAL_LANDMARKS_IDXS["left_eye"])
+        self.right_eye = slice(*face_utils.FACIAL_LANDMARKS_IDXS["right_eye"])
+
+    def extract(self, frame: np.ndarray, record: np.void):
+        """
+        Fill one `FEATURE_DTYPE` record (everything but `frame_idx` and `timestamp`) from a BGR frame.
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        box = self.tracker.update(frame)
+        if box is None:
+            record['face'] = 0
+            record['x'] = record['y'] = record['w'] = record['h'] = 0
+            record['landmarks'] = np.nan
+            record['yaw'] = record['pitch'] = record['roll'] = np.nan
+            record['ear_left'] = record['ear_right'] = np.nan
+            return
+
+        x, y, w, h = box
+        shape = face_utils.shape_to_np(self.predictor(gray, dlib.rectangle(x, y, x + w, y + h)))
+        record['face'] = 1
+        record['x'], record['y'], record['w'], record['h'] = x, y, w, h
+        record['landmarks'] = shape
+        record['yaw'], record['pitch'], record['roll'] = head_pose(shape, (frame.shape[1], frame.shape[0]))
+        record['ear_left'] = eye_aspect_ratio(shape[self.left_eye])
+        record['ear_right'] = eye_aspect_ratio(shape[self.right_eye])
+
+
+def arrow_table(chunk: np.ndarray):
+    columns = {}
+    for name in FEATURE_DTYPE.names:
+        if name == 'landmarks':
+            for i in range(68):
+                columns["lm%d_x" % i] = chunk['landmarks'][:, i, 0]
+                columns["lm%d_y" % i] = chunk['landmarks'][:, i, 1]
+        else:
+            columns[name] = chunk[name]
+    return pa.table(columns)
+
+
+class FeatureWriter:
+    """
+    Columnar feature file written in fixed-size chunks, so memory stays bounded however long the session is.
+    With pyarrow installed, `.parquet` paths get one row group per chunk and landmarks flattened to `lmN_x`/`lmN_y`
+    columns; otherwise the file is a header followed by `FEATURE_DTYPE` records, read back by `load_features`.
+
+    :param chunk: rows per chunk / row group
+    """
+    def __init__(self, path: str, chunk: int = 1024):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        if self.parquet and pa is None:
+            raise RuntimeError("Writing %s needs pyarrow" % path)
+        self.buffer = np.zeros(chunk, dtype=FEATURE_DTYPE)
+        self.n = 0
+        self.rows = 0
+        self.writer = None
+        self.output = None
+        if not self.parquet:
+            self.output = open(path, 'wb')
+            self.output.write(HEADER.pack(MAGIC, VERSION))
+
+    def next_record(self) -> np.void:
+        """
+        :return: the next row, to be filled in place
+        """
+        if self.n == len(self.buffer):
+            self.flush()
+        record = self.buffer[self.n]
+        self.n += 1
+        return record
+
+    def flush(self):
+        if self.n == 0:
+            return
+        chunk = self.buffer[:self.n]
+        if self.parquet:
+            table = arrow_table(chunk)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            self.output.write(chunk.tobytes())
+            self.output.flush()
+        self.rows += self.n
+        self.n = 0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        if self.output is not None:
+            self.output.close()
+
+
+def load_features(path: str) -> np.ndarray:
+    """
+    Memory-map a non-Parquet feature file written by `FeatureWriter`.
+
+    :return: structured array of `FEATURE_DTYPE`
+    """
+    return load_records(path, MAGIC, FEATURE_DTYPE, HEADER, VERSION)[1]
+
+
+def extract_session(session, extractor: LandmarkExtractor, writer: FeatureWriter,
+                    start: int = 0, stop: Optional[int] = None,
+                    progress: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Stream frames of a `utils.session.Session` through the extractor into the writer.
+
+    :param progress: called with the number of frames processed so far, every 100 frames
+    :return: number of frames processed
+    """
+    n = 0
+    for frame_idx, timestamp, frame in session.frames(start, stop):
+        record = writer.next_record()
+        record['frame_idx'] = frame_idx
+        record['timestamp'] = timestamp
+        extractor.extract(frame, record)
+        n += 1
+        if progress is not None and n % 100 == 0:
+            progress(n)
+    return n
@@ -0,0 +1,166 @@
+from collections import deque
+from threading import Lock
+import struct
+import json
+import time
+import sys
+
+from typing import *
+
+from utils.logwriter import BatchedWriter
+
+
+MAGIC = b'LOG1'
+VERSION = 1
+HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<dI')  # time, length of the UTF-8 text that follows
+
+
+def state_name(state) -> str:
+    return getattr(state, "name", "" if state is None else str(state))
+
+
+def format_payload(payload: tuple) -> str:
+    return ",".join(str(v) for v in payload)
+
+
+def format_csv(record: tuple) -> str:
+    """
+    The `main_log.txt` layout: `time,State.NAME,event[,payload...]`.
+    """
+    t, state, event, payload = record
+    if len(payload) == 0:
+        return "%f,%s,%s\n" % (t, state, event)
+    return "%f,%s,%s,%s\n" % (t, state, event, format_payload(payload))
+
+
+def format_jsonl(record: tuple) -> str:
+    t, state, event, payload = record
+    return json.dumps({"t": t, "state": state_name(state), "event": event, "payload": list(payload)},
+                      default=str) + "\n"
+
+
+def format_binary(record: tuple) -> bytes:
+    t, state, event, payload = record
+    text = ",".join([state_name(state), event] + [str(v) for v in payload]).encode('UTF-8')
+    return RECORD.pack(t, len(text)) + text
+
+
+def format_mirror(record: tuple) -> str:
+    """
+    What `ExpApp.log` used to print: the event and its payload.
+    """
+    t, state, event, payload = record
+    if len(payload) == 0:
+        return event + "\n"
+    return "%s,%s\n" % (event, format_payload(payload))
+
+
+FORMATS = {
+    "csv": (format_csv, False),
+    "jsonl": (format_jsonl, False),
+    "binary": (format_binary, True),
+}
+
+
+class EventLogger(BatchedWriter):
+    """
+    Structured application log. `log` only timestamps the (state, event, payload) record and appends it to
+    an in-memory queue and to a ring of the most recent records; formatting, writing and the optional
+    stdout mirror all happen in batches on the writer thread.
+
+    :param path: output file
+    :param log_format: 'csv' (the `main_log.txt` layout), 'jsonl', or 'binary' (read back with `read_binary`)
+    :param mirror: stream that also receives `event,payload` lines, e.g. `sys.stdout`; None to disable
+    :param ring_size: number of recent records kept for `recent`
+    """
+    def __init__(self, path: str, log_format: str = "csv", mirror: Optional[IO[str]] = None, ring_size: int = 1024,
+                 batch_size: int = 256, interval: float = 0.2):
+        if log_format not in FORMATS:
+            raise ValueError("Unknown log format %s" % log_format)
+        formatter, binary = FORMATS[log_format]
+        super().__init__(path, formatter, batch_size=batch_size, interval=interval, binary=binary,
+                         header=HEADER.pack(MAGIC, VERSION) if binary else None)
+        self.mirror = mirror
+        self.ring = deque(maxlen=ring_size)
+        self.lock = Lock()
+        self.appended = 0
+
+    def log(self, state, event: str, *payload):
+        """
+        :param state: current state, formatted only on the writer thread
+        :param event: event name; a legacy `"event,fields"` line is split into event and payload fields
+        :param payload: typed fields
+        """
+        if len(payload) == 0 and "," in event:
+            event, *payload = event.split(",")
+        with self.lock:  # Called from the GUI, preview and shutdown threads; keeps `appended` in queue order
+            record = (time.time(), state, event, payload)
+            self.ring.append(record)
+            self.append(record)
+            self.appended += 1
+
+    def recent(self, n: Optional[int] = None) -> List[tuple]:
+        """
+        :return: the last `n` records (all in the ring by default), oldest first
+        """
+        records = list(self.ring)
+        return records if n is None else records[-n:]
+
+    def drain(self):
+        n = len(self.records)
+        if n == 0:
+            return
+        batch = [self.records.popleft() for _ in range(n)]
+        self.output.write((b"" if self.binary else "").join(self.formatter(r) for r in batch))
+        self.output.flush()
+        if self.mirror is not None:
+            try:
+                self.mirror.write("".join(format_mirror(r) for r in batch))
+                self.mirror.flush()
+            except (OSError, ValueError):  # Mirror closed
+                self.mirror = None
+        self.written += n
+
+    def sync(self, timeout: float = 1.0) -> bool:
+        """
+        Wait until everything logged so far is written, e.g. before the log file is archived.
+
+        :return: False on timeout
+        """
+        target = self.appended
+        deadline = time.monotonic() + timeout
+        while self.written < target:
+            if not self.is_alive() or time.monotonic() >= deadline:
+                return False
+            self.flush()
+            time.sleep(0.005)
+        return True
+
+
+def read_binary(path: str) -> Iterator[Tuple[float, str, str, List[str]]]:
+    """
+    Read a binary log written by `EventLogger`.
+
+    :return: iterator of (time, state name, event, payload fields as text)
+    """
+    with open(path, 'rb') as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a binary application log" % path)
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            t, length = RECORD.unpack(head)
+            text = f.read(length)
+            if len(text) < length:  # Interrupted write
+                return
+            fields = text.decode('UTF-8').split(",")
+            yield t, fields[0], fields[1] if len(fields) > 1 else "", fields[2:]
+
+
+if __name__ == '__main__':
+    for arg in sys.argv[1:]:
+        for t, state, event, payload in read_binary(arg):
+            print(format_csv((t, "State.%s" % state, event, tuple(payload))), end="")
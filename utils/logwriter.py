@@ -0,0 +1,88 @@
+from threading import Thread, Event
+from collections import deque
+import time
+import os
+
+from typing import *
+
+
+class BatchedWriter(Thread):
+    """
+    Log file written by a background thread.
+    Producers only append a tuple to an in-memory queue; the writer formats and writes them in batches,
+    either once `batch_size` records are pending or every `interval` seconds, so callers never block on disk I/O.
+
+    :param path: output file
+    :param formatter: turns a record into the text (or bytes, with `binary`) written to the file
+    :param batch_size: wake the writer early once this many records are pending
+    :param interval: maximum time a record stays in memory
+    :param binary: the formatter returns bytes
+    :param header: written once when the file is opened
+    :param write_time: `utils.metrics.Histogram` receiving the time to format and write each batch, in ms
+    """
+    def __init__(self, path: str, formatter: Callable[[tuple], Union[str, bytes]], batch_size: int = 256,
+                 interval: float = 0.1, binary: bool = False, header: Union[str, bytes, None] = None,
+                 write_time=None):
+        super().__init__(daemon=True)
+        self.path = path
+        self.formatter = formatter
+        self.batch_size = batch_size
+        self.interval = interval
+        self.binary = binary
+        self.records = deque()
+        self.wake = Event()
+        self.stopped = False
+        self.written = 0
+        self.write_time = write_time
+        if binary:
+            self.output = open(path, 'wb')
+        else:
+            self.output = open(path, 'w', encoding='UTF-8')
+        if header:
+            self.output.write(header)
+
+    def append(self, record: tuple):
+        self.records.append(record)
+        if len(self.records) >= self.batch_size:
+            self.wake.set()
+
+    def drain(self):
+        n = len(self.records)
+        if n == 0:
+            return
+        start = time.perf_counter()
+        batch = [self.formatter(self.records.popleft()) for _ in range(n)]
+        self.output.write((b"" if self.binary else "").join(batch))
+        self.output.flush()
+        self.written += n
+        if self.write_time is not None:
+            self.write_time.observe((time.perf_counter() - start) * 1000)
+
+    def run(self) -> None:
+        while not self.stopped:
+            self.wake.wait(timeout=self.interval)
+            self.wake.clear()
+            self.drain()
+        self.finalize()
+
+    def finalize(self):
+        self.drain()
+        os.fsync(self.output.fileno())
+        self.output.close()
+
+    def flush(self):
+        """
+        Ask the writer thread to write every pending record now.
+        """
+        self.wake.set()
+
+    def close(self, timeout=None):
+        """
+        Stop the writer thread after it flushed the remaining records and closed the file.
+        """
+        self.stopped = True
+        self.wake.set()
+        if self.is_alive():
+            self.join(timeout=timeout)
+        elif not self.output.closed:
+            self.finalize()
@@ -0,0 +1,288 @@
+import numpy as np
+
+import heapq
+import json
+import re
+
+from typing import *
+
+from utils.session import Session
+from utils import eventlog, logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+class Record(NamedTuple):
+    """
+    One event of the merged session timeline.
+    `frame` is the last video frame captured at or before `t` (-1 before the first frame)
+    and `state` the `ExpApp` state last logged to the main log (`main_log.txt`, `.jsonl` or `.bin`).
+    """
+    t: float
+    source: str  # e.g. 'main', 'video', 'mouse_Main', 'keyboard_waiting', 'probe_waiting'
+    kind: str  # e.g. 'frame', 'move', 'click', 'press', 'sound', 'probe', or the first field of a main log line
+    value: str = ""  # button, key, answer, or the rest of a main log line
+    x: int = 0
+    y: int = 0
+    dx: int = 0  # scroll delta, or 1 for a button press
+    dy: int = 0
+    ref_t: float = float('nan')  # time of the sound a probe answers
+    frame: int = -1
+    state: str = ""
+
+
+RECORD_DTYPE = np.dtype([
+    ('t', '<f8'),
+    ('source', 'U24'),
+    ('kind', 'U24'),
+    ('value', 'U64'),
+    ('x', '<i4'),
+    ('y', '<i4'),
+    ('dx', '<i4'),
+    ('dy', '<i4'),
+    ('ref_t', '<f8'),
+    ('frame', '<i8'),
+    ('state', 'U24'),
+])
+
+
+def read_main_log(f: IO[str]) -> Iterator[Record]:
+    for line in f:
+        fields = line.rstrip("\n").split(",", 2)
+        if len(fields) < 3:
+            continue
+        message = fields[2].split(",", 1)
+        state = fields[1].split(".")[-1]  # 'State.MAIN_VIDEO'
+        yield Record(float(fields[0]), "main", message[0], message[1] if len(message) > 1 else "", state=state)
+
+
+def read_main_log_jsonl(f: IO[str]) -> Iterator[Record]:
+    """
+    `main_log.jsonl`, written by `EventLogger` with `log_format='jsonl'`.
+    """
+    for line in f:
+        if line.strip() == "":
+            continue
+        entry = json.loads(line)
+        yield Record(entry["t"], "main", entry["event"], ",".join(str(v) for v in entry["payload"]),
+                     state=entry["state"])
+
+
+def read_main_log_binary(path: str) -> Iterator[Record]:
+    """
+    `main_log.bin`, written by `EventLogger` with `log_format='binary'`.
+    """
+    for t, state, event, payload in logger.read_binary(path):
+        yield Record(t, "main", event, ",".join(payload), state=state)
+
+
+def read_video_timeline(f: IO[str]) -> Iterator[Record]:
+    for line in f:
+        fields = line.strip().split(",")
+        if fields[0] == "":
+            continue
+        yield Record(float(fields[0]), "video", "frame" if len(fields) == 1 else fields[1])
+
+
+def read_mouse_log(f: IO[str], source: str) -> Iterator[Record]:
+    for line in f:
+        fields = line.strip().split(",")
+        if len(fields) < 3:
+            continue
+        t, kind = float(fields[0]), fields[2]
+        if kind == "move":
+            yield Record(t, source, kind, x=int(fields[3]), y=int(fields[4]))
+        elif kind == "click":
+            yield Record(t, source, kind, fields[3], int(fields[5]), int(fields[6]), dx=int(fields[4]))
+        elif kind == "scroll":
+            yield Record(t, source, kind, x=int(fields[3]), y=int(fields[4]), dx=int(fields[5]), dy=int(fields[6]))
+
+
+def read_keyboard_log(f: IO[str], source: str) -> Iterator[Record]:
+    for line in f:
+        fields = line.rstrip("\n").split(",", 3)  # The key itself may be ','
+        if len(fields) == 4:
+            yield Record(float(fields[0]), source, fields[2], fields[3])
+
+
+def read_probe_log(f: IO[str], source: str) -> Iterator[Record]:
+    """
+    Sounds are placed at their own time, answers at the time of the response.
+    """
+    for line in f:
+        fields = line.strip().split(",")
+        if len(fields) == 2 and fields[1] == "sound":
+            yield Record(float(fields[0]), source, "sound")
+        elif len(fields) == 4 and fields[2] == "probe":
+            yield Record(float(fields[1]), source, "probe", fields[3], ref_t=float(fields[0]))
+
+
+def read_event_log(path: str, source: str, chunk: int = 65536) -> Iterator[Record]:
+    """
+    Binary `mouse_log_<name>.bin` / `keyboard_log_<name>.bin`, read through the memory map in chunks.
+    """
+    events = eventlog.load_events(path)
+    for start in range(0, len(events), chunk):
+        for event in events[start:start + chunk]:
+            line = eventlog.format_event(event)
+            if line.split(",", 2)[1] == "mouse":
+                yield from read_mouse_log([line], source)
+            else:
+                yield from read_keyboard_log([line], source)
+
+
+def session_streams(session: Session) -> Dict[str, Callable[[], Iterator[Record]]]:
+    """
+    :return: a lazily opened stream per log file of the session, keyed by source name
+    """
+    def opened(name, reader, *args):
+        def stream():
+            with session.open(name) as f:
+                yield from reader(f, *args)
+        return stream
+
+    streams = {}
+    names = session.names()
+    if "main_log.txt" in names:
+        streams["main"] = opened("main_log.txt", read_main_log)
+    elif "main_log.jsonl" in names:
+        streams["main"] = opened("main_log.jsonl", read_main_log_jsonl)
+    elif "main_log.bin" in names:
+        streams["main"] = lambda: read_main_log_binary(session.local_path("main_log.bin"))
+    timelines = [s["timeline"] for s in session.segments()] if any(n.startswith("recording") for n in names) else []
+    if len(timelines) > 0:
+        def video():
+            for timeline in timelines:
+                with session.open(timeline) as f:
+                    yield from read_video_timeline(f)
+        streams["video"] = video
+    for name in sorted(names, key=lambda n: n.endswith(".bin")):
+        match = re.fullmatch(r"(mouse|keyboard|probe)_(?:log_)?(.+)\.(txt|bin)", name)
+        if match is None:
+            continue
+        kind, log, extension = match.groups()
+        source = "%s_%s" % (kind, log)
+        if source in streams:  # Prefer the text log when both exist
+            continue
+        if extension == "bin":
+            if kind != "probe":
+                streams[source] = (lambda n=name, s=source: read_event_log(session.local_path(n), s))
+        elif kind == "mouse":
+            streams[source] = opened(name, read_mouse_log, source)
+        elif kind == "keyboard":
+            streams[source] = opened(name, read_keyboard_log, source)
+        else:
+            streams[source] = opened(name, read_probe_log, source)
+    return streams
+
+
+def merge_streams(streams: Iterable[Iterator[Record]], include_frames: bool = True) -> Iterator[Record]:
+    """
+    k-way merge of time-ordered streams with `heapq.merge`; only one pending record per stream is held in memory.
+    Every record gets the frame index and the `ExpApp` state current at its time.
+
+    :param include_frames: also yield the video frame records themselves
+    """
+    frame = -1
+    state = ""
+    for record in heapq.merge(*streams, key=lambda r: r.t):
+        if record.source == "video":
+            if record.kind == "frame":
+                frame += 1
+            if not include_frames:
+                continue
+        elif record.source == "main" and record.state != "":
+            state = record.state
+        yield record._replace(frame=frame, state=state)
+
+
+def merge_session(session: Session, sources: Optional[Iterable[str]] = None,
+                  include_frames: bool = True) -> Iterator[Record]:
+    """
+    One time-ordered stream of every log of a session.
+
+    :param sources: restrict to these source names (the video timeline is always read for the frame index)
+    """
+    streams = session_streams(session)
+    if sources is not None:
+        sources = set(sources) | {"video"}
+        streams = {k: v for k, v in streams.items() if k in sources}
+    return merge_streams([stream() for stream in streams.values()], include_frames)
+
+
+def to_array(records: Iterable[Record]) -> np.ndarray:
+    """
+    :return: structured array of `RECORD_DTYPE`
+    """
+    return np.array([tuple(r) for r in records], dtype=RECORD_DTYPE)
+
+
+def write_npy(records: Iterable[Record], path: str, chunk: int = 65536) -> int:
+    """
+    Write a `.npy` file of `RECORD_DTYPE` in chunks; the header is rewritten at the end, once the length is known.
+
+    :return: number of records
+    """
+    size = len(npy_header(2 ** 63 - 1))  # Room for any length
+    n = 0
+    with open(path, 'wb') as f:
+        f.write(b" " * size)
+        for batch in batched(records, chunk):
+            f.write(to_array(batch).tobytes())
+            n += len(batch)
+        f.seek(0)
+        f.write(npy_header(n, size))
+    return n
+
+
+def npy_header(n: int, size: Optional[int] = None) -> bytes:
+    """
+    `.npy` version 1.0 header of `n` records, padded to `size` bytes (by default, the next multiple of 64).
+    """
+    header = {'descr': np.lib.format.dtype_to_descr(RECORD_DTYPE), 'fortran_order': False, 'shape': (n,)}
+    text = repr(header).encode('latin1')
+    prefix = b"\x93NUMPY\x01\x00"
+    if size is None:
+        size = (len(prefix) + 2 + len(text) + 1 + 63) // 64 * 64
+    length = size - len(prefix) - 2
+    return prefix + length.to_bytes(2, 'little') + text + b" " * (length - len(text) - 1) + b"\n"
+
+
+def write_parquet(records: Iterable[Record], path: str, chunk: int = 65536) -> int:
+    """
+    Write a Parquet file with one row group per `chunk` records.
+
+    :return: number of records
+    """
+    if pa is None:
+        raise RuntimeError("Writing %s needs pyarrow" % path)
+    writer = None
+    n = 0
+    try:
+        for batch in batched(records, chunk):
+            array = to_array(batch)
+            table = pa.table({name: array[name] for name in RECORD_DTYPE.names})
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+            n += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n
+
+
+def batched(records: Iterable[Record], size: int) -> Iterator[List[Record]]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
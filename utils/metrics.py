@@ -0,0 +1,169 @@
+from threading import Thread, Event, Lock
+from bisect import bisect_left
+import json
+import time
+
+from typing import *
+
+
+# Upper bounds of the histogram buckets, in ms; one more bucket holds everything above
+DEFAULT_BOUNDS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 12, 16, 20, 25, 33, 40, 50, 66, 100, 150, 250, 500, 1000)
+
+
+class Counter:
+    """
+    Monotonic count, e.g. frames written. Reported with its rate per second over the last interval.
+    """
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+    def snapshot(self, previous: Optional[dict], dt: float) -> dict:
+        value = self.value
+        since = previous["value"] if previous is not None else 0
+        return {"value": value, "rate": (value - since) / dt if dt > 0 else 0.}
+
+
+class Gauge:
+    """
+    Current value, either set by its owner or read from `fn` when a snapshot is taken (e.g. a queue depth),
+    which keeps it off the hot path entirely.
+    """
+    def __init__(self, fn: Optional[Callable[[], float]] = None):
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def snapshot(self, previous: Optional[dict], dt: float) -> float:
+        if self.fn is not None:
+            try:
+                return self.fn()
+            except Exception:
+                return None
+        return self.value
+
+
+class Histogram:
+    """
+    Distribution of durations in ms over fixed buckets. Snapshots report the count, mean, percentiles and maximum
+    of the observations since the previous snapshot, from the difference of the cumulative bucket counts.
+    """
+    def __init__(self, bounds: Sequence[float] = DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.  # since the previous snapshot
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, counts: List[int], q: float) -> float:
+        """
+        :return: upper bound of the bucket holding the `q` quantile (the maximum for the overflow bucket)
+        """
+        target = q * sum(counts)
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= target and n > 0:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return 0.
+
+    def snapshot(self, previous: Optional[dict], dt: float) -> dict:
+        counts = list(self.counts)
+        total, total_sum, peak = self.count, self.sum, self.max
+        self.max = 0.
+        if previous is not None:
+            window = [c - p for c, p in zip(counts, previous["buckets"])]
+            n, window_sum = total - previous["count"], total_sum - previous["sum"]
+        else:
+            window, n, window_sum = counts, total, total_sum
+        return {"count": total, "sum": total_sum, "buckets": counts, "n": n,
+                "mean": window_sum / n if n > 0 else 0., "p50": self.percentile(window, 0.5),
+                "p95": self.percentile(window, 0.95), "max": peak}
+
+
+class Registry:
+    """
+    Named metrics of the running session. Getters create a metric on first use and return the same one afterwards,
+    so a component can be restarted under the same names.
+
+    Metrics are plain attribute updates without locks: each one should be updated from a single thread,
+    and the reporter reads them concurrently, which is exact enough for diagnostics.
+    """
+    def __init__(self):
+        self.metrics: Dict[str, Union[Counter, Gauge, Histogram]] = {}
+        self.lock = Lock()
+
+    def get(self, name: str, factory: Callable[[], Any]):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = factory()
+            return metric
+
+    def counter(self, name: str) -> Counter:
+        return self.get(name, Counter)
+
+    def gauge(self, name: str, fn: Optional[Callable[[], float]] = None) -> Gauge:
+        gauge = self.get(name, lambda: Gauge(fn))
+        if fn is not None:
+            gauge.fn = fn  # Rebind to the latest owner
+        return gauge
+
+    def histogram(self, name: str, bounds: Sequence[float] = DEFAULT_BOUNDS) -> Histogram:
+        return self.get(name, lambda: Histogram(bounds))
+
+    def snapshot(self, previous: Dict[str, Any], dt: float) -> Dict[str, Any]:
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return {name: metric.snapshot(previous.get(name), dt) for name, metric in metrics}
+
+
+# Registry shared by the recorders of the session
+REGISTRY = Registry()
+
+
+class MetricsReporter(Thread):
+    """
+    Append a snapshot of every metric of `registry` to a JSON lines file every `interval` seconds
+    and once more when finished: `{"t": <time>, "dt": <seconds since the previous line>, "metrics": {...}}`.
+    Histograms also carry their cumulative bucket counts, so any window can be recomputed offline.
+    """
+    def __init__(self, path: str, registry: Optional[Registry] = None, interval: float = 5.0):
+        super().__init__(daemon=True)
+        self.path = path
+        self.registry = registry if registry is not None else REGISTRY
+        self.interval = interval
+        self.stopped = Event()
+        self.snapshots = 0
+
+    def run(self) -> None:
+        previous = {}
+        last = time.monotonic()
+        with open(self.path, 'w', encoding='UTF-8') as f:
+            while True:
+                stopping = self.stopped.wait(timeout=self.interval)
+                now = time.monotonic()
+                snapshot = self.registry.snapshot(previous, now - last)
+                f.write(json.dumps({"t": time.time(), "dt": now - last, "metrics": snapshot}) + "\n")
+                f.flush()
+                self.snapshots += 1
+                previous, last = snapshot, now
+                if stopping:
+                    break
+
+    def finish(self, timeout=None):
+        """
+        Write a last snapshot and close the file; `join` waits for it.
+        """
+        self.stopped.set()
@@ -0,0 +1,123 @@
+from PyQt5.QtWidgets import QLabel, qApp
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap
+import numpy as np
+import cv2
+
+from threading import Lock
+
+from typing import *
+
+
+class Preview(QObject):
+    """
+    Camera preview shown in a `QLabel`.
+
+    A worker thread renders frames with `render` into one of three reused buffers and hands them over with `publish`,
+    which only signals the GUI thread; the GUI thread keeps nothing but the latest published frame
+    and repaints at most once per display refresh. All Qt widget calls happen on the GUI thread.
+
+    Create it on the GUI thread.
+
+    :param label: widget the preview is drawn in
+    :param refresh_rate: repaint limit in Hz, defaults to the refresh rate of the primary screen
+    """
+    frame_ready = pyqtSignal()
+
+    def __init__(self, label: QLabel, refresh_rate: Optional[float] = None):
+        super().__init__()
+        self.label = label
+        if refresh_rate is None:
+            refresh_rate = qApp.primaryScreen().refreshRate() or 60.
+        self.height = max(1, label.height())  # Read by the worker, updated on the GUI thread
+
+        self.lock = Lock()
+        self.buffers: List[Optional[np.ndarray]] = [None, None, None]
+        self.scratch: Optional[np.ndarray] = None
+        self.latest: Optional[int] = None  # Buffer published last
+        self.showing: Optional[int] = None  # Buffer being converted by the GUI thread
+        self.pending = False
+        self.dirty = False
+
+        self.pixmap = QPixmap()
+        self.painted = 0
+        self.rendered = 0
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(max(1, int(1000 / refresh_rate)))
+        self.timer.timeout.connect(self.on_timeout)
+        self.frame_ready.connect(self.on_frame_ready)
+
+    def render(self, frame: np.ndarray, mirror: bool = True) -> Tuple[int, np.ndarray]:
+        """
+        Scale a BGR capture frame to the label height (and mirror it) into a free buffer. Worker thread only.
+
+        :return: (buffer index, buffer); draw on the buffer, then `publish` the index
+        """
+        h, w = frame.shape[:2]
+        height = self.height
+        width = max(1, int(w * height / h))
+        shape = (height, width) + frame.shape[2:]
+
+        with self.lock:
+            index = next(i for i in range(len(self.buffers)) if i != self.latest and i != self.showing)
+        if self.buffers[index] is None or self.buffers[index].shape != shape:
+            self.buffers[index] = np.empty(shape, dtype=frame.dtype)
+        buffer = self.buffers[index]
+
+        if mirror:
+            if self.scratch is None or self.scratch.shape != shape:
+                self.scratch = np.empty(shape, dtype=frame.dtype)
+            cv2.resize(frame, (width, height), dst=self.scratch, interpolation=cv2.INTER_AREA)
+            cv2.flip(self.scratch, 1, dst=buffer)
+        else:
+            cv2.resize(frame, (width, height), dst=buffer, interpolation=cv2.INTER_AREA)
+        self.rendered += 1
+        return index, buffer
+
+    def publish(self, index: int):
+        """
+        Make a rendered buffer the latest frame. Worker thread only.
+        """
+        with self.lock:
+            self.latest = index
+            notify = not self.pending
+            self.pending = True
+        if notify:
+            self.frame_ready.emit()
+
+    def on_frame_ready(self):
+        with self.lock:
+            self.pending = False
+        if self.timer.isActive():
+            self.dirty = True  # Painted when the timer expires
+        else:
+            self.paint()
+            self.timer.start()
+
+    def on_timeout(self):
+        if self.dirty:
+            self.paint()
+            self.timer.start()
+
+    def paint(self):
+        self.dirty = False
+        self.height = max(1, self.label.height())
+        with self.lock:
+            self.showing = self.latest
+        if self.showing is None:
+            return
+        buffer = self.buffers[self.showing]
+        h, w, c = buffer.shape
+        image = QImage(buffer.data, w, h, buffer.strides[0], QImage.Format_BGR888)
+        self.pixmap.convertFromImage(image)  # Copies, so the buffer is free again afterwards
+        with self.lock:
+            self.showing = None
+        self.label.setPixmap(self.pixmap)
+        self.painted += 1
+
+    def stop(self):
+        self.timer.stop()
+        with self.lock:
+            self.latest = None
@@ -1,8 +1,10 @@
 from pynput import mouse, keyboard
+import numpy as np
 import cv2
 
-from multiprocessing import Event, SimpleQueue, Value
-from threading import Thread
+from multiprocessing import Event
+from queue import SimpleQueue
+from threading import Thread, Condition
 import traceback
 import signal
 import time
@@ -11,7 +13,18 @@ import os
 
 from typing import *
 
-from utils import sound
+from utils import sound, camera
+from utils.encoder import make_encoder, ENCODERS
+from utils.segment import SegmentedOutput
+from utils.logwriter import BatchedWriter
+from utils.capture import CaptureService
+from utils import eventlog
+from utils.metrics import Registry, REGISTRY
+
+
+# Default depth of the frame ring, as seconds of video: every slot is a preallocated frame (2.7 MB at 720p)
+RING_SECONDS = 0.5
+MIN_RING_SIZE = 8
 
 
 def get_resource(name):
@@ -21,17 +34,174 @@ def get_resource(name):
         return "./resources/" + name
 
 
+class FrameRing:
+    """
+    Bounded ring of preallocated frame buffers between one capture thread and one encoder thread.
+    The producer never waits: when every slot is occupied the incoming frame is dropped and counted.
+
+    :param size: number of slots
+    :param nbytes: capacity of a single slot in bytes
+    """
+    def __init__(self, size: int, nbytes: int):
+        self.size = size
+        self.nbytes = nbytes
+        self.buffers = np.empty((size, nbytes), dtype=np.uint8)
+        self.shapes: List[Optional[tuple]] = [None] * size
+        self.meta: List[Any] = [None] * size
+        self.head = 0  # next slot to write (producer only)
+        self.tail = 0  # next slot to read (consumer only)
+        self.count = 0
+        self.pushed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.closed = False
+        self.cond = Condition()
+
+    @property
+    def depth(self) -> int:
+        return self.count
+
+    def push(self, frame: np.ndarray, meta: Any = None) -> bool:
+        if self.count >= self.size or frame.nbytes > self.nbytes:
+            self.dropped += 1
+            return False
+
+        slot = self.head
+        np.copyto(self.buffers[slot, :frame.nbytes], frame.reshape(-1).view(np.uint8))
+        self.shapes[slot] = frame.shape
+        self.meta[slot] = meta
+        self.head = (slot + 1) % self.size
+
+        with self.cond:
+            self.count += 1
+            self.pushed += 1
+            self.max_depth = max(self.max_depth, self.count)
+            self.cond.notify()
+        return True
+
+    def peek(self, timeout=None) -> Optional[Tuple[np.ndarray, Any]]:
+        """
+        Wait for the oldest frame. The returned array is a view into the ring,
+        so call `advance()` once it is consumed.
+
+        :return: (frame, meta), or None on timeout or when the ring is closed and drained
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.count > 0 or self.closed, timeout=timeout):
+                return None
+            if self.count == 0:
+                return None
+
+        slot = self.tail
+        shape = self.shapes[slot]
+        frame = self.buffers[slot, :int(np.prod(shape))].reshape(shape)
+        return frame, self.meta[slot]
+
+    def advance(self):
+        self.tail = (self.tail + 1) % self.size
+        with self.cond:
+            self.count -= 1
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class FrameCounter:
+    """
+    Frame counter for threads of the same process.
+    The capture loop is the only writer, and it only takes the lock when someone waits in `wait_for`.
+    """
+    def __init__(self):
+        self.value = 0
+        self.base = 0
+        self.target = None
+        self.cond = Condition()
+
+    @property
+    def count(self) -> int:
+        return self.value - self.base
+
+    def increment(self):
+        self.value += 1
+        target = self.target
+        if target is not None and self.value >= target:
+            with self.cond:
+                self.cond.notify_all()
+
+    def reset(self):
+        self.base = self.value
+
+    def wait_for(self, n: int, timeout=None) -> bool:
+        """
+        Block until `n` frames were counted since the last `reset()`.
+
+        :return: False on timeout
+        """
+        with self.cond:
+            goal = self.base + n
+            self.target = goal if self.target is None else min(self.target, goal)
+            try:
+                return self.cond.wait_for(lambda: self.value >= goal, timeout=timeout)
+            finally:
+                self.target = None
+
+
 class VideoRecorder(Thread):
-    def __init__(self, base_path:str,  cam: int):
+    def __init__(self, base_path:str,  cam: int, buffered: bool = True, ring_size: Optional[int] = None,
+                 binary_timeline: bool = True, encoder: str = "mpeg", encoder_options: Optional[dict] = None,
+                 segment_length: Optional[float] = None, mode: Optional[camera.CameraMode] = None,
+                 source: Optional[CaptureService] = None, on_segment_closed: Optional[Callable[[List[str]], None]] = None,
+                 metrics: Optional[Registry] = None, log: Callable[[str], None] = print):
+        """
+        :param base_path: output directory
+        :param cam: camera index
+        :param buffered: capture and encode on separate threads through a `FrameRing`
+        :param ring_size: number of frames the ring can hold while the encoder is stalled;
+                          by default `RING_SECONDS` of video at the capture fps
+        :param binary_timeline: also write monotonic timestamps to `video_timeline.bin` (see `utils.timeline`)
+        :param encoder: video backend name (see `utils.encoder.ENCODERS`)
+        :param encoder_options: keyword arguments for the backend
+        :param segment_length: start a new video segment every `segment_length` seconds (see `utils.segment`)
+        :param mode: capture mode chosen by `camera.negotiate_mode`, otherwise the driver default at 30 fps
+        :param source: running `CaptureService` to record from; otherwise the recorder opens `cam` itself
+        :param on_segment_closed: called with the paths of every finished video segment and its timelines
+        :param metrics: registry receiving `video.frames` (its rate is the capture fps), `video.written`,
+                        `video.write_ms`, `video.dropped` and `video.ring_depth`
+        :param log: receives the recording statistics and errors, e.g. `ExpApp.log`
+        """
         super().__init__()
+        if source is not None and encoder in ENCODERS and ENCODERS[encoder].configures_capture:
+            raise ValueError("Encoder %s configures the capture device and cannot record from a shared source"
+                             % encoder)
         self.event = Event()
         self.proceed_event = Event()
+        self.stop_event = Event()
         self.cam = cam
-        self.video_timeline = None
+        self.source = source
         self.video_cap = None
-        self.video_out = None
-        self.val = Value('i', 0, lock=True)
+        self.video_out: Optional[SegmentedOutput] = None
+        self.encoder = encoder
+        self.encoder_options = encoder_options or {}
+        self.counter = FrameCounter()
         self.base_path = base_path
+        self.buffered = buffered
+        self.ring_size = ring_size
+        self.ring: Optional[FrameRing] = None
+        self.encoder_thread: Optional[Thread] = None
+        self.binary_timeline = binary_timeline
+        self.segment_length = segment_length
+        self.on_segment_closed = on_segment_closed
+        self.rotate_requested = False
+        self.mode = mode
+        self.log = log
+        self.metrics = metrics if metrics is not None else REGISTRY
+        self.frame_count = self.metrics.counter("video.frames")
+        self.written_count = self.metrics.counter("video.written")
+        self.write_time = self.metrics.histogram("video.write_ms")
+        self.metrics.gauge("video.dropped", self.getDroppedFrames)
+        self.metrics.gauge("video.ring_depth", self.getRingDepth)
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
 
@@ -40,9 +210,8 @@ class VideoRecorder(Thread):
             traceback.print_stack(frame)
             print("SIGINT FROM CHILD!", flush=True)
 
-        self.output.close()
-        if self.video_cap is not None:
-            self.video_out.release()
+        if self.video_out is not None:
+            self.video_out.close()
 
         self.event.set()
         sys.exit(0)
@@ -53,55 +222,168 @@ class VideoRecorder(Thread):
 
     def finish(self, timeout=None):
         self.event.clear()
+        self.stop_event.set()
         self.event.wait(timeout=timeout)
 
     def setFrameCount(self):
-        with self.val.get_lock():
-            self.val.value = 0
+        self.counter.reset()
 
     def getFrameCount(self):
-        return self.val.value
-
-    def run(self) -> None:
-        self.output = open(os.path.join(self.base_path, "video_timeline.txt"), 'w', buffering=1, encoding='UTF-8')
-        if sys.platform == "darwin":
-            self.video_cap = cv2.VideoCapture(self.cam)
+        return self.counter.count
+
+    def wait_for_frames(self, n: int, timeout=None) -> bool:
+        """
+        Block until `n` frames were captured since the last `setFrameCount()`.
+
+        :return: False on timeout
+        """
+        return self.counter.wait_for(n, timeout=timeout)
+
+    def getRingDepth(self):
+        return self.ring.depth if self.ring is not None else 0
+
+    def getDroppedFrames(self):
+        return self.ring.dropped if self.ring is not None else 0
+
+    def rotate_segment(self):
+        """
+        Close the current video segment at the next frame and continue in a new one, e.g. at the end of a phase.
+        Only effective with `segment_length`.
+        """
+        if self.segment_length is not None:
+            self.rotate_requested = True
+
+    def write_frame(self, frame, stamp):
+        start = time.perf_counter()
+        if self.rotate_requested:  # Rotate on the writing thread, between two frames
+            self.rotate_requested = False
+            self.video_out.rotate()
+        self.video_out.write(frame, stamp)
+        self.write_time.observe((time.perf_counter() - start) * 1000)
+        self.written_count.inc()
+
+    def on_frame(self, frame, stamp):
+        if self.ring is not None:
+            self.ring.push(frame, stamp)
         else:
-            self.video_cap = cv2.VideoCapture(self.cam, cv2.CAP_DSHOW)
-        self.video_cap.set(cv2.CAP_PROP_FPS, 30)
+            self.write_frame(frame, stamp)
+        self.counter.increment()
+        self.frame_count.inc()
+
+    def encode_loop(self):
+        while True:
+            item = self.ring.peek()
+            if item is None:
+                break
+            frame, stamp = item
+            self.write_frame(frame, stamp)
+            self.ring.advance()
 
-        size = (int(self.video_cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
-                int(self.video_cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
-
-        assert (self.video_cap.isOpened())
+    def run(self) -> None:
+        own_source = self.source is None
+        if own_source:
+            cap = camera.open_camera(self.cam)
+            if self.mode is not None:
+                camera.apply_mode(cap, self.mode.width, self.mode.height, self.mode.fourcc, 30)
+            else:
+                cap.set(cv2.CAP_PROP_FPS, 30)
+
+            # Only safe while nobody else reads from the device
+            make_encoder(self.encoder, **self.encoder_options).configure_capture(cap)
+
+            assert (cap.isOpened())
+            self.source = CaptureService(cap, metrics=self.metrics, log=self.log)
+
+        self.video_cap = self.source.cap
+        size = self.source.size
+
+        self.video_out = SegmentedOutput(self.base_path, lambda: make_encoder(self.encoder, **self.encoder_options),
+                                         size, 30.0, segment_length=self.segment_length,
+                                         binary_timeline=self.binary_timeline, on_closed=self.on_segment_closed,
+                                         log=self.log)
+
+        if self.buffered:
+            ring_size = self.ring_size
+            if ring_size is None:
+                fps = self.video_cap.get(cv2.CAP_PROP_FPS) or 30  # 0 when the driver does not report it
+                ring_size = max(MIN_RING_SIZE, int(fps * RING_SECONDS))
+            self.ring = FrameRing(ring_size, size[0] * size[1] * 3)
+            self.log("videoRecorder,ring,%d,%.1fMB" % (ring_size, ring_size * size[0] * size[1] * 3 / 2 ** 20))
+            self.encoder_thread = Thread(target=self.encode_loop, daemon=True)
+            self.encoder_thread.start()
 
-        fourcc = cv2.VideoWriter_fourcc(*'mpeg')
-        self.video_out = cv2.VideoWriter(os.path.join(self.base_path, "recording.mp4"), fourcc, 30.0, size)
         self.event.wait()
         self.proceed_event.set()
-        while self.event.is_set():
-            ret, frame = self.video_cap.read()
-            curr_time = time.time()
-            if ret and frame is not None:
-                self.video_out.write(frame)
-                self.output.write("%f\n" % curr_time)
-                with self.val.get_lock():
-                    self.val.value += 1
-        self.output.write("%f,end" % time.time())
-        self.video_out.release()
+        token = self.source.subscribe(self.on_frame)
+        if own_source:
+            self.source.start()
+
+        self.stop_event.wait()
+        self.source.unsubscribe(token)
+        if own_source:
+            self.source.stop()
+
+        if self.ring is not None:
+            self.ring.close()
+            self.encoder_thread.join()
+            self.log("videoRecorder,pushed,%d,dropped,%d,max_depth,%d"
+                     % (self.ring.pushed, self.ring.dropped, self.ring.max_depth))
+        self.log("videoRecorder,encoder,%s,frames,%d,mean_encode_ms,%f"
+                 % (self.encoder, self.video_out.frames, self.video_out.mean_encode_time * 1000))
+        self.video_out.close(end_line="%f,end" % time.time())
         cv2.destroyAllWindows()
-        self.output.close()
         self.event.set()
 
 
 class ActivityRecorder(Thread):
-    def __init__(self, base_path: str, queue: SimpleQueue, name: str):
+    # Listener callbacks only enqueue (kind, time, *fields); the writers format them with these
+    MOUSE_FORMATS = {
+        "move": "%f,mouse,move,%d,%d\n",
+        "click": "%f,mouse,click,%s,%d,%d,%d\n",
+        "scroll": "%f,mouse,scroll,%d,%d,%d,%d\n",
+    }
+    KEY_FORMATS = {
+        "press": "%f,key,press,%s\n",
+        "release": "%f,key,release,%s\n",
+    }
+
+    def __init__(self, base_path: str, queue: SimpleQueue, name: str, log_format: str = "text",
+                 move_window: Optional[float] = None, metrics: Optional[Registry] = None,
+                 log: Callable[[str], None] = print):
+        """
+        :param base_path: output directory
+        :param queue: receives (time, 'y'/'n') probe responses
+        :param name: suffix of the log files
+        :param log_format: 'text' for `*_log_<name>.txt`, 'binary' for packed `*_log_<name>.bin` (see `utils.eventlog`)
+        :param move_window: coalesce mouse moves to at most one per `move_window` seconds,
+                            keeping every direction change, the last position of each window (where the cursor
+                            comes to rest) and the last position before clicks and scrolls
+        :param metrics: registry receiving, per listener, `activity.<name>.mouse_events` / `keyboard_events`
+                        (their rate is events/s) and `activity.<name>.mouse_write_ms` / `keyboard_write_ms`
+        :param log: receives the recorder statistics, e.g. `ExpApp.log`
+        """
         super().__init__()
+        if log_format not in ("text", "binary"):
+            raise ValueError("Unknown log format %s" % log_format)
+        self.log_format = log_format
+        self.move_window = move_window
+        self.log = log
+        self.pending_move = None  # latest (t, x, y) not yet logged
+        self.last_move = None  # latest raw (x, y)
+        self.last_move_time = 0.
+        self.direction = (0, 0)
+        self.raw_moves = 0
+        self.merged_moves = 0
         self.event = Event()
         self.finishEvent = Event()
         self.queue = queue
         self.name = name
         self.base_path = base_path
+        metrics = metrics if metrics is not None else REGISTRY
+        self.mouse_events = metrics.counter("activity.%s.mouse_events" % name)
+        self.keyboard_events = metrics.counter("activity.%s.keyboard_events" % name)
+        self.mouse_write_time = metrics.histogram("activity.%s.mouse_write_ms" % name)
+        self.keyboard_write_time = metrics.histogram("activity.%s.keyboard_write_ms" % name)
         self.mouse_listener = mouse.Listener(
             on_move=self.onMouseMove,
             on_click=self.onMouseClick,
@@ -122,8 +404,8 @@ class ActivityRecorder(Thread):
             print(e)
 
         try:
-            self.keyboard_output.close()
-            self.mouse_output.close()
+            self.keyboard_output.close(timeout=1.0)
+            self.mouse_output.close(timeout=1.0)
         except Exception as e:
             print(e)
 
@@ -140,28 +422,72 @@ class ActivityRecorder(Thread):
         self.event.set()
         self.finishEvent.wait(timeout=timeout)
 
-    def key_log(self, string: str):
-        self.keyboard_output.write("%f,%s\n" % (time.time(), string))
+    def files(self) -> List[str]:
+        """
+        :return: paths of the mouse and keyboard logs, complete once the recorder finished
+        """
+        extension = "bin" if self.log_format == "binary" else "txt"
+        return [os.path.join(self.base_path, "%s_log_%s.%s" % (kind, self.name, extension))
+                for kind in ("mouse", "keyboard")]
 
-    def mouse_log(self, string: str):
-        self.mouse_output.write("%f,%s\n" % (time.time(), string))
+    def key_log(self, kind: str, key):
+        self.keyboard_output.append((kind, time.time(), key))
+        self.keyboard_events.inc()
+
+    def mouse_log(self, kind: str, *fields):
+        self.mouse_output.append((kind, time.time()) + fields)
+        self.mouse_events.inc()
+
+    def log_move(self, t, x, y):
+        self.mouse_output.append(("move", t, x, y))
+        self.mouse_events.inc()
+        self.last_move_time = t
+
+    def flush_move(self):
+        if self.pending_move is not None:
+            self.log_move(*self.pending_move)
+            self.pending_move = None
 
     def onMouseMove(self, x, y):
-        self.mouse_log("mouse,move,%d,%d" % (x, y))
+        curr_time = time.time()
+        self.raw_moves += 1
+        if self.move_window is None:
+            self.log_move(curr_time, x, y)
+            return
+
+        turned = False
+        if self.last_move is not None:
+            step = ((x > self.last_move[0]) - (x < self.last_move[0]), (y > self.last_move[1]) - (y < self.last_move[1]))
+            turned = any(s * d < 0 for s, d in zip(step, self.direction))
+            self.direction = tuple(s if s != 0 else d for s, d in zip(step, self.direction))
+        self.last_move = (x, y)
+
+        if turned:
+            self.flush_move()  # Keep the turning point
+        if self.pending_move is not None and curr_time - self.last_move_time >= self.move_window:
+            self.flush_move()  # Trailing edge: the last position of the elapsed window, e.g. before an idle period
+        if curr_time - self.last_move_time >= self.move_window:
+            self.log_move(curr_time, x, y)
+        else:
+            if self.pending_move is not None:
+                self.merged_moves += 1  # Replaced by a newer move of the same window
+            self.pending_move = (curr_time, x, y)
 
     def onMouseClick(self, x, y, button, pressed):
-        self.mouse_log("mouse,click,%s,%d,%d,%d" % (button, pressed, x, y))
+        self.flush_move()
+        self.mouse_log("click", button, pressed, x, y)
 
     def onMouseScroll(self, x, y, dx, dy):
-        self.mouse_log("mouse,scroll,%d,%d,%d,%d" % (x, y, dx, dy))
+        self.flush_move()
+        self.mouse_log("scroll", x, y, dx, dy)
 
     def onKeyPress(self, key):
         if isinstance(key, keyboard.KeyCode):
             if key in [keyboard.KeyCode.from_char(1), keyboard.KeyCode.from_char(0)]:
-                self.key_log("key,press,%s" % str(key))
+                self.key_log("press", key)
         elif hasattr(key, 'vk') and 96 <= key.vk <= 105:
             if key.vk in [96, 97]:
-                self.key_log("key,press,%s" % str(key))
+                self.key_log("press", key)
 
     def onKeyRelease(self, key):
         curr_time = time.time()
@@ -169,26 +495,38 @@ class ActivityRecorder(Thread):
             if key in [keyboard.KeyCode.from_char(1)]:
                 self.queue.put((curr_time, 'y'))
                 sound.play(get_resource("Keyboard.mp3"))
-                self.key_log("key,release,%s" % str(key))
+                self.key_log("release", key)
             elif key in [keyboard.KeyCode.from_char(0)]:
                 self.queue.put((curr_time, 'n'))
                 sound.play(get_resource("Keyboard.mp3"))
-                self.key_log("key,release,%s" % str(key))
+                self.key_log("release", key)
         elif hasattr(key, 'vk') and 96 <= key.vk <= 105:  # numpad
             if key.vk == 97:
                 self.queue.put((curr_time, 'y'))
                 sound.play(get_resource("Keyboard.mp3"))
-                self.key_log("key,release,%s" % str(key))
+                self.key_log("release", key)
             elif key.vk == 96:
                 self.queue.put((curr_time, 'n'))
                 sound.play(get_resource("Keyboard.mp3"))
-                self.key_log("key,release,%s" % str(key))
+                self.key_log("release", key)
 
     def run(self) -> None:
-        self.mouse_output = open(os.path.join(self.base_path, "mouse_log_%s.txt" % self.name), 'w', buffering=1,
-                                 encoding='UTF-8')
-        self.keyboard_output = open(os.path.join(self.base_path, "keyboard_log_%s.txt" % self.name), 'w', buffering=1,
-                                    encoding='UTF-8')
+        if self.log_format == "binary":
+            self.mouse_output = BatchedWriter(os.path.join(self.base_path, "mouse_log_%s.bin" % self.name),
+                                              eventlog.pack_event, binary=True, header=eventlog.header(),
+                                              write_time=self.mouse_write_time)
+            self.keyboard_output = BatchedWriter(os.path.join(self.base_path, "keyboard_log_%s.bin" % self.name),
+                                                 eventlog.pack_event, binary=True, header=eventlog.header(),
+                                                 write_time=self.keyboard_write_time)
+        else:
+            self.mouse_output = BatchedWriter(os.path.join(self.base_path, "mouse_log_%s.txt" % self.name),
+                                              lambda r: self.MOUSE_FORMATS[r[0]] % r[1:],
+                                              write_time=self.mouse_write_time)
+            self.keyboard_output = BatchedWriter(os.path.join(self.base_path, "keyboard_log_%s.txt" % self.name),
+                                                 lambda r: self.KEY_FORMATS[r[0]] % r[1:],
+                                                 write_time=self.keyboard_write_time)
+        self.mouse_output.start()
+        self.keyboard_output.start()
         self.event.wait()
 
         self.mouse_listener.start()
@@ -200,6 +538,9 @@ class ActivityRecorder(Thread):
         self.mouse_listener.stop()
         self.keyboard_listener.stop()
 
+        self.flush_move()
+        self.log("activityRecorder,%s,moves,%d,merged,%d" % (self.name, self.raw_moves, self.merged_moves))
+
         self.mouse_output.close()
         self.keyboard_output.close()
 
@@ -0,0 +1,31 @@
+import numpy as np
+
+import struct
+import os
+
+from typing import *
+
+
+HEADER = struct.Struct('<4sI')  # magic, version
+
+
+def load_records(path: str, magic: bytes, dtype: np.dtype, header: struct.Struct = HEADER,
+                 version: int = 1) -> Tuple[tuple, np.ndarray]:
+    """
+    Memory-map a binary file made of a header starting with (magic, version) and fixed-width records.
+    A trailing partial record left by an interrupted write is ignored.
+
+    :param header: layout of the whole header
+    :return: (header fields, structured array of `dtype`)
+    """
+    with open(path, 'rb') as f:
+        fields = header.unpack(f.read(header.size))
+    if fields[0] != magic:
+        raise ValueError("%s does not start with the %s header" % (path, magic.decode("ascii", "replace")))
+    if fields[1] != version:
+        raise ValueError("Unsupported %s version %d in %s" % (magic.decode("ascii", "replace"), fields[1], path))
+
+    n = (os.path.getsize(path) - header.size) // dtype.itemsize
+    if n == 0:
+        return fields, np.empty(0, dtype=dtype)
+    return fields, np.memmap(path, dtype=dtype, mode='r', offset=header.size, shape=(n,))
@@ -0,0 +1,194 @@
+from threading import Thread, Lock
+from queue import Queue
+import json
+import time
+import os
+
+from typing import *
+
+from utils.encoder import Encoder
+from utils.timeline import TimelineWriter
+
+
+MANIFEST = "segments.json"
+
+
+class Segment:
+    """
+    One video file with its own text and binary timeline slices.
+    Frame indices in the binary timeline are local to the segment; add `first_frame` for the session index.
+    """
+    def __init__(self, base_path: str, index: Optional[int], encoder: Encoder, size, fps, first_frame: int,
+                 binary_timeline: bool):
+        suffix = "" if index is None else "_%03d" % index
+        self.index = index
+        self.first_frame = first_frame
+        self.frames = 0
+        self.start = time.time()
+        self.end = None
+
+        self.video = "recording%s.%s" % (suffix, encoder.extension)
+        self.timeline = "video_timeline%s.txt" % suffix
+        self.binary_timeline = "video_timeline%s.bin" % suffix if binary_timeline else None
+
+        self.video_out = encoder
+        self.video_out.open(os.path.join(base_path, self.video), size, fps)
+        self.output = open(os.path.join(base_path, self.timeline), 'w', buffering=1, encoding='UTF-8')
+        self.timeline_out = None
+        if binary_timeline:
+            self.timeline_out = TimelineWriter(os.path.join(base_path, self.binary_timeline))
+
+    def write(self, frame, stamp):
+        monotonic_ns, wall_ns, pos_msec = stamp
+        self.video_out.write(frame)
+        self.output.write("%f\n" % (wall_ns / 1e9))
+        if self.timeline_out is not None:
+            self.timeline_out.write(self.frames, monotonic_ns, wall_ns, pos_msec)
+        self.frames += 1
+
+    def release(self):
+        self.video_out.release()
+        self.output.close()
+        if self.timeline_out is not None:
+            self.timeline_out.close()
+
+    def files(self, base_path: str) -> List[str]:
+        names = [self.video, self.timeline] + ([self.binary_timeline] if self.binary_timeline else [])
+        if os.path.isfile(os.path.join(base_path, self.video + ".json")):  # `RawEncoder` sidecar
+            names.append(self.video + ".json")
+        return [os.path.join(base_path, name) for name in names]
+
+    def describe(self, closed: bool) -> dict:
+        return {
+            "index": self.index,
+            "video": self.video,
+            "timeline": self.timeline,
+            "binary_timeline": self.binary_timeline,
+            "first_frame": self.first_frame,
+            "frames": self.frames,
+            "start": self.start,
+            "end": self.end,
+            "closed": closed,
+        }
+
+
+class SegmentedOutput:
+    """
+    Video output of `VideoRecorder`, optionally split into rolling segments.
+    Without `segment_length` it writes the usual `recording.<ext>` / `video_timeline.txt`.
+
+    With `segment_length`, a new `recording_NNN.<ext>` starts every `segment_length` seconds.
+    Finished segments are released on a background thread, so the writer never waits for a container
+    to be finalized, and `segments.json` is atomically rewritten whenever a segment opens or closes.
+    A crash therefore loses at most the segment that was open.
+
+    :param on_closed: called on the closer thread with the paths of every released segment's files
+    """
+    def __init__(self, base_path: str, encoder_factory: Callable[[], Encoder], size: Tuple[int, int], fps: float,
+                 segment_length: Optional[float] = None, binary_timeline: bool = True,
+                 on_closed: Optional[Callable[[List[str]], None]] = None, log: Callable[[str], None] = print):
+        self.base_path = base_path
+        self.log = log
+        self.encoder_factory = encoder_factory
+        self.size = size
+        self.fps = fps
+        self.segment_length = segment_length
+        self.binary_timeline = binary_timeline
+        self.on_closed = on_closed
+
+        self.frames = 0
+        self.encode_time = 0.
+        self.next_index = 0
+        self.closed: List[dict] = []
+        self.manifest_lock = Lock()
+
+        self.closing = Queue()
+        self.closer = Thread(target=self.close_loop, daemon=True)
+        self.closer.start()
+
+        self.current = self.open_segment()
+
+    @property
+    def mean_encode_time(self) -> float:
+        return self.encode_time / self.frames if self.frames > 0 else 0.
+
+    def open_segment(self) -> Segment:
+        index = None
+        if self.segment_length is not None:
+            index = self.next_index
+            self.next_index += 1
+        segment = Segment(self.base_path, index, self.encoder_factory(), self.size, self.fps, self.frames,
+                          self.binary_timeline)
+        if self.segment_length is not None:
+            self.write_manifest(segment)
+        return segment
+
+    def write(self, frame, stamp):
+        if self.segment_length is not None and stamp[1] / 1e9 - self.current.start >= self.segment_length:
+            self.rotate()
+        encode_time = self.current.video_out.encode_time
+        self.current.write(frame, stamp)
+        self.encode_time += self.current.video_out.encode_time - encode_time
+        self.frames += 1
+
+    def rotate(self):
+        """
+        Hand the current segment to the closer thread and continue in a new one.
+        """
+        previous = self.current
+        previous.end = time.time()
+        self.current = self.open_segment()
+        self.closing.put(previous)
+
+    def close(self, end_line: Optional[str] = None):
+        """
+        Finalize every segment and stop the closer thread.
+
+        :param end_line: written at the end of the last text timeline
+        """
+        if self.current is None:
+            return
+        segment, self.current = self.current, None
+        segment.end = time.time()
+        if end_line is not None:
+            segment.output.write(end_line)
+        self.closing.put(segment)
+        self.closing.put(None)
+        self.closer.join()
+
+    def close_loop(self):
+        while True:
+            segment = self.closing.get()
+            if segment is None:
+                break
+            try:
+                segment.release()
+            except Exception as e:
+                self.log("segment,%s,%s" % (segment.video, e))
+            with self.manifest_lock:
+                self.closed.append(segment.describe(closed=True))
+            if self.segment_length is not None:
+                self.write_manifest(self.current)
+            if self.on_closed is not None:
+                try:
+                    self.on_closed(segment.files(self.base_path))
+                except Exception as e:
+                    self.log("segment,%s,%s" % (segment.video, e))
+
+    def write_manifest(self, current: Optional[Segment]):
+        with self.manifest_lock:
+            segments = list(self.closed)
+            if current is not None:
+                segments.append(current.describe(closed=False))
+            manifest = {
+                "segment_length": self.segment_length,
+                "fps": self.fps,
+                "size": list(self.size),
+                "segments": segments,
+            }
+            path = os.path.join(self.base_path, MANIFEST)
+            with open(path + ".tmp", 'w', encoding='UTF-8') as f:
+                json.dump(manifest, f, indent=1)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
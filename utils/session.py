@@ -0,0 +1,259 @@
+import numpy as np
+import cv2
+
+from threading import Lock
+import zipfile
+import io
+import tempfile
+import shutil
+import glob
+import json
+import os
+
+from typing import *
+
+from utils.segment import MANIFEST
+from utils.timeline import TimelineReader
+
+
+VIDEO_EXTENSIONS = ("mp4", "avi", "mkv", "mjpeg", "yuv", "rgb")
+
+
+class VideoReader:
+    """
+    Sequential frame reader over a recording, with seeking.
+    Container formats go through `cv2.VideoCapture`; raw `.yuv`/`.rgb` files written by `RawEncoder`
+    are memory-mapped using their `.json` sidecar.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.position = 0
+        self.raw = None
+        self.cap = None
+        sidecar = path + ".json"
+        if os.path.isfile(sidecar):
+            with open(sidecar, 'r', encoding='UTF-8') as f:
+                info = json.load(f)
+            w, h = info["width"], info["height"]
+            self.pix_fmt = info["pix_fmt"]
+            shape = (h * 3 // 2, w) if self.pix_fmt == "yuv420p" else (h, w, 3)
+            n = os.path.getsize(path) // int(np.prod(shape))
+            self.raw = np.memmap(path, dtype=np.uint8, mode='r', shape=(n,) + shape) if n > 0 else np.empty((0,) + shape, np.uint8)
+        else:
+            self.cap = cv2.VideoCapture(path)
+            if not self.cap.isOpened():
+                raise IOError("Cannot open video %s" % path)
+
+    def __len__(self):
+        if self.raw is not None:
+            return len(self.raw)
+        return int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def seek(self, frame_idx: int):
+        if self.raw is None and frame_idx != self.position:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        self.position = frame_idx
+
+    def read(self) -> Optional[np.ndarray]:
+        """
+        :return: the next BGR frame, or None at the end of the video
+        """
+        if self.raw is not None:
+            if self.position >= len(self.raw):
+                return None
+            frame = self.raw[self.position]
+            if self.pix_fmt == "yuv420p":
+                frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
+            else:
+                frame = np.array(frame)
+        else:
+            ret, frame = self.cap.read()
+            if not ret:
+                return None
+        self.position += 1
+        return frame
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+        self.raw = None
+
+
+def load_text_timeline(f: IO[str]) -> np.ndarray:
+    """
+    Parse `video_timeline.txt`, one wall-clock timestamp per frame; the trailing `<time>,end` line is skipped.
+
+    :return: float seconds since epoch, one per frame
+    """
+    times = []
+    for line in f:
+        line = line.strip()
+        if line == "" or "," in line:
+            continue
+        times.append(float(line))
+    return np.array(times, dtype=np.float64)
+
+
+class Session:
+    """
+    A recorded session, either the session directory (`output/`, `outputN/`) or the final `output_user_<id>.zip`.
+    Archive members are extracted on demand into a temporary directory, removed again by `close`.
+    Frames can be streamed from several threads at once; each `frames` call uses its own reader.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+        self.archive = None
+        self.tmp = None
+        self.lock = Lock()
+        self.times: Dict[str, np.ndarray] = {}
+        if os.path.isfile(path) and zipfile.is_zipfile(path):
+            self.archive = zipfile.ZipFile(path)
+            self.members = {os.path.normpath(n).replace(os.sep, "/"): n
+                            for n in self.archive.namelist() if not n.endswith("/")}
+        elif not os.path.isdir(path):
+            raise IOError("Not a session directory or archive: %s" % path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def names(self) -> List[str]:
+        if self.archive is not None:
+            return sorted(self.members)
+        return sorted(os.listdir(self.path))
+
+    def exists(self, name: str) -> bool:
+        if self.archive is not None:
+            return name in self.members
+        return os.path.isfile(os.path.join(self.path, name))
+
+    def open(self, name: str) -> IO[str]:
+        """
+        Open a text file of the session; archive members are streamed without extracting them.
+        """
+        if self.archive is not None:
+            return io.TextIOWrapper(self.archive.open(self.members[name]), encoding='UTF-8')
+        return open(os.path.join(self.path, name), 'r', encoding='UTF-8')
+
+    def local_path(self, name: str) -> str:
+        """
+        :return: a path on disk for `name`, extracting it from the archive if needed
+        """
+        if self.archive is None:
+            return os.path.join(self.path, name)
+        with self.lock:
+            if self.tmp is None:
+                self.tmp = tempfile.mkdtemp(prefix="session_%s_" % self.name)
+            path = os.path.join(self.tmp, name)
+            if not os.path.isfile(path):
+                with self.archive.open(self.members[name]) as src, open(path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+        return path
+
+    def segments(self) -> List[dict]:
+        """
+        :return: the `segments.json` entries, or a single entry for an unsegmented recording
+        """
+        if self.exists(MANIFEST):
+            with self.open(MANIFEST) as f:
+                return json.load(f)["segments"]
+        videos = [n for n in self.names() if os.path.splitext(n)[0] == "recording"
+                  and os.path.splitext(n)[1][1:] in VIDEO_EXTENSIONS]
+        if len(videos) == 0:
+            raise IOError("No recording in %s" % self.path)
+        return [{
+            "index": None,
+            "video": videos[0],
+            "timeline": "video_timeline.txt",
+            "binary_timeline": "video_timeline.bin" if self.exists("video_timeline.bin") else None,
+            "first_frame": 0,
+        }]
+
+    def timestamps(self, segment: dict) -> np.ndarray:
+        """
+        :return: wall-clock time of every frame of the segment; the binary timeline is preferred when present
+        """
+        times = self.times.get(segment["timeline"])
+        if times is None:
+            if segment.get("binary_timeline") and self.exists(segment["binary_timeline"]):
+                times = TimelineReader(self.local_path(segment["binary_timeline"])).wall_times()
+            else:
+                with self.open(segment["timeline"]) as f:
+                    times = load_text_timeline(f)
+            self.times[segment["timeline"]] = times
+        return times
+
+    def timeline(self) -> np.ndarray:
+        """
+        :return: wall-clock time of every session frame, indexed by session frame index
+        """
+        segments = self.segments()
+        if len(segments) == 0:
+            return np.empty(0, dtype=np.float64)
+        return np.concatenate([self.timestamps(s) for s in segments])
+
+    def open_video(self, segment: dict) -> VideoReader:
+        video = segment["video"]
+        if self.archive is not None and self.exists(video + ".json"):
+            self.local_path(video + ".json")
+        return VideoReader(self.local_path(video))
+
+    def frames(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, float, np.ndarray]]:
+        """
+        Stream frames one at a time across segments.
+
+        :param start: first session frame index
+        :param stop: session frame index to stop before (None for the end)
+        :return: iterator of (session frame index, wall-clock timestamp, BGR frame)
+        """
+        for segment in self.segments():
+            times = self.timestamps(segment)
+            first = segment.get("first_frame", 0)
+            end = first + len(times)
+            if end <= start or (stop is not None and first >= stop):
+                continue
+            reader = self.open_video(segment)
+            try:
+                local = max(0, start - first)
+                reader.seek(local)
+                while local < len(times) and (stop is None or first + local < stop):
+                    frame = reader.read()
+                    if frame is None:
+                        break
+                    yield first + local, float(times[local]), frame
+                    local += 1
+            finally:
+                reader.release()
+
+    def frame_count(self) -> int:
+        return sum(len(self.timestamps(s)) for s in self.segments())
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+        if self.tmp is not None:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+            self.tmp = None
+
+
+def find_sessions(paths: Iterable[str]) -> List[str]:
+    """
+    Expand the given paths into session directories and archives.
+    A folder that holds a recording is a session; otherwise its `output*` directories and `output_user_*.zip`
+    archives are.
+    """
+    sessions = []
+    for path in paths:
+        if os.path.isfile(path):
+            sessions.append(path)
+            continue
+        if any(os.path.isfile(p) for p in glob.glob(os.path.join(path, "recording*"))):
+            sessions.append(path)
+            continue
+        for candidate in sorted(glob.glob(os.path.join(path, "output*"))):
+            if os.path.isdir(candidate) or candidate.endswith(".zip"):
+                sessions.append(candidate)
+    return sessions
@@ -0,0 +1,109 @@
+from threading import Thread, Event
+import time
+
+from typing import *
+
+
+class Component(NamedTuple):
+    name: str
+    stop: Callable[[float], Any]  # receives the seconds left until the deadline
+    after: Tuple[str, ...]  # components that must have stopped first
+
+
+class Result(NamedTuple):
+    name: str
+    status: str  # 'ok', 'timeout', 'blocked: <dependency>' or 'error: <message>'
+    elapsed: float  # seconds spent in the component's own `stop`
+    waited: float = 0.  # seconds spent waiting for the components in `after`
+
+
+def finisher(component) -> Callable[[float], None]:
+    """
+    Stop function for the recorder threads: `finish(timeout)`, then `join` whatever is left of the timeout.
+    A `finish` returning False counts as a timeout.
+    """
+    def stop(timeout: float):
+        deadline = time.monotonic() + timeout
+        if component.finish(timeout=timeout) is False:
+            raise TimeoutError("finish timed out")
+        if isinstance(component, Thread):
+            component.join(timeout=max(0., deadline - time.monotonic()))
+            if component.is_alive():
+                raise TimeoutError("still running")
+    return stop
+
+
+class ShutdownCoordinator:
+    """
+    Stop every component of a session in parallel against one global deadline.
+
+    Each component's `stop(timeout)` runs on its own daemon thread and should signal the component, then wait for it
+    at most `timeout` seconds, the time left until the deadline. Components listed in `after` are waited for first.
+    `run` returns by the deadline whatever the components do; those still running are reported as timed out.
+    A component that times out only because a dependency did not stop in time is reported as blocked instead.
+
+    :param log: receives one `shutdown,<name>,<status>,<stop ms>,wait,<dependency wait ms>` line per component
+                and a `shutdown,total,<ms>,slowest,<name>` line naming the component with the longest own stop time
+    """
+    def __init__(self, log: Callable[[str], None] = print):
+        self.log = log
+        self.components: List[Component] = []
+
+    def add(self, name: str, stop: Callable[[float], Any], after: Iterable[str] = ()):
+        self.components.append(Component(name, stop, tuple(after)))
+
+    def run(self, timeout: float = 10.0) -> List[Result]:
+        start = time.monotonic()
+        deadline = start + timeout
+        done: Dict[str, Event] = {c.name: Event() for c in self.components}
+        results: Dict[str, Result] = {}
+        started: Dict[str, float] = {}
+
+        def stop(component: Component):
+            blocked = None
+            for name in component.after:
+                if name in done and (not done[name].wait(timeout=max(0., deadline - time.monotonic()))
+                                     or results[name].status != "ok"):
+                    blocked = blocked or name
+            stop_start = started[component.name] = time.monotonic()
+            try:
+                component.stop(max(0., deadline - stop_start))
+                status = "ok"
+            except TimeoutError:
+                status = "timeout" if blocked is None else "blocked: %s" % blocked
+            except Exception as e:
+                status = "error: %s" % e
+            results[component.name] = Result(component.name, status, time.monotonic() - stop_start, stop_start - start)
+            done[component.name].set()
+
+        threads = [Thread(target=stop, args=(c,), daemon=True, name="shutdown-%s" % c.name) for c in self.components]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=max(0., deadline - time.monotonic()))
+
+        ordered = []
+        now = time.monotonic()
+        for component in self.components:
+            result = results.get(component.name)
+            blocked = [name for name in component.after
+                       if name in done and (name not in results or results[name].status != "ok")]
+            if result is None:
+                stop_start = started.get(component.name)
+                if stop_start is None:  # Never began its own stop: still waiting for a dependency
+                    result = Result(component.name, "timeout", 0., now - start)
+                else:
+                    result = Result(component.name, "timeout", now - stop_start, stop_start - start)
+            if result.status == "ok" and result.waited + result.elapsed > timeout:
+                result = result._replace(status="timeout")
+            if result.status == "timeout" and len(blocked) > 0:
+                # Late because of the dependency; its thread still sends the stop signal once the wait ends
+                result = result._replace(status="blocked: %s" % blocked[0])
+            ordered.append(result)
+            self.log("shutdown,%s,%s,%.1f,wait,%.1f" % (result.name, result.status, result.elapsed * 1000,
+                                                         result.waited * 1000))
+
+        slowest = max(ordered, key=lambda r: r.elapsed) if ordered else None
+        self.log("shutdown,total,%.1f,slowest,%s" % ((time.monotonic() - start) * 1000,
+                                                     slowest.name if slowest is not None else ""))
+        return ordered
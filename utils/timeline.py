@@ -0,0 +1,102 @@
+import numpy as np
+
+import struct
+import time
+
+from typing import *
+
+from utils.records import load_records
+
+
+MAGIC = b'VTL1'
+VERSION = 1
+HEADER = struct.Struct('<4sIqq8x')  # magic, version, anchor monotonic_ns, anchor wall_ns (padded to 32 bytes)
+RECORD = struct.Struct('<qqqd')
+RECORD_DTYPE = np.dtype([
+    ('frame_idx', '<i8'),
+    ('monotonic_ns', '<i8'),
+    ('wall_ns', '<i8'),
+    ('pos_msec', '<f8'),
+])
+assert RECORD.size == RECORD_DTYPE.itemsize
+
+
+class TimelineWriter:
+    """
+    Append-only binary video timeline.
+    The file starts with a header holding a monotonic-to-wall clock anchor,
+    followed by fixed-width `RECORD_DTYPE` records so it can be memory-mapped by `TimelineReader`.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.anchor = (time.monotonic_ns(), time.time_ns())
+        self.output = open(path, 'wb')
+        self.output.write(HEADER.pack(MAGIC, VERSION, *self.anchor))
+        self.frames = 0
+
+    def write(self, frame_idx: int, monotonic_ns: int, wall_ns: int, pos_msec: float):
+        self.output.write(RECORD.pack(frame_idx, monotonic_ns, wall_ns, pos_msec))
+        self.frames += 1
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        self.output.close()
+
+
+class TimelineReader:
+    """
+    Memory-mapped view over a file written by `TimelineWriter`.
+    Lookups from a timestamp to a frame are binary searches over the mapped records.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        (magic, version, anchor_mono, anchor_wall), self.records = load_records(path, MAGIC, RECORD_DTYPE,
+                                                                                HEADER, VERSION)
+        self.anchor = (anchor_mono, anchor_wall)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, item):
+        return self.records[item]
+
+    def to_wall_ns(self, monotonic_ns):
+        return monotonic_ns - self.anchor[0] + self.anchor[1]
+
+    def wall_times(self) -> np.ndarray:
+        """
+        Frame timestamps on the wall clock, reconstructed from the monotonic clock and the anchor,
+        so they are immune to wall-clock jumps during the session.
+
+        :return: float seconds since epoch, one per frame
+        """
+        return self.to_wall_ns(self.records['monotonic_ns']) / 1e9
+
+    def frame_at(self, timestamp_ns: int, clock: str = 'monotonic') -> int:
+        """
+        Find the last frame captured at or before the given time.
+
+        :param timestamp_ns: timestamp in nanoseconds
+        :param clock: 'monotonic' or 'wall'
+        :return: frame index, or -1 if the timestamp is before the first frame
+        """
+        if clock == 'wall':
+            timestamp_ns = timestamp_ns - self.anchor[1] + self.anchor[0]
+        elif clock != 'monotonic':
+            raise ValueError("Unknown clock %s" % clock)
+
+        pos = int(np.searchsorted(self.records['monotonic_ns'], timestamp_ns, side='right')) - 1
+        if pos < 0:
+            return -1
+        return int(self.records['frame_idx'][pos])
+
+    def time_of(self, frame_idx: int) -> int:
+        """
+        :return: monotonic_ns of the given frame
+        """
+        pos = int(np.searchsorted(self.records['frame_idx'], frame_idx, side='left'))
+        if pos >= len(self.records) or self.records['frame_idx'][pos] != frame_idx:
+            raise KeyError(frame_idx)
+        return int(self.records['monotonic_ns'][pos])